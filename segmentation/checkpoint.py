@@ -0,0 +1,152 @@
+import io
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+from ast import literal_eval
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+# file layout: MAGIC | uint32 length of the metadata | metadata (utf-8 json) | torch.save(state_dict)
+MAGIC = b'SEGCKPT1'
+_LENGTH = struct.Struct('<I')
+
+
+def checkpoint_metadata(architecture, encoder: str, classes: int, color_map: dict = None):
+    '''
+    Everything needed to rebuild the model and its input preprocessing without the training settings
+    '''
+    from segmentation_models_pytorch import encoders
+    try:
+        preprocessing = encoders.get_preprocessing_params(encoder)
+    except Exception:
+        preprocessing = None
+    return {'architecture': architecture.value,
+            'encoder': encoder,
+            'classes': classes,
+            'preprocessing': preprocessing,
+            'color_map': {str(k): v for k, v in color_map.items()} if color_map else None}
+
+
+def color_map_from_metadata(metadata: dict):
+    color_map = metadata.get('color_map')
+    return {literal_eval(k): v for k, v in color_map.items()} if color_map else None
+
+
+def save_checkpoint(path: str, state_dict, metadata: dict):
+    header = json.dumps(metadata).encode('utf-8')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(_LENGTH.pack(len(header)))
+        f.write(header)
+        torch.save(state_dict, f)
+    # readers never see a partially written checkpoint
+    os.replace(tmp_path, path)
+
+
+def _read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        return None
+    length, = _LENGTH.unpack(f.read(_LENGTH.size))
+    return json.loads(f.read(length).decode('utf-8'))
+
+
+def _read_legacy_meta(path: str):
+    metadata = {}
+    with open(os.path.splitext(path)[0] + '.meta') as f:
+        for x in f.readlines():
+            x = x.strip('\n')
+            if x.startswith('Encoder'):
+                metadata['encoder'] = x.split(" ")[1]
+            if x.startswith('Architecture'):
+                metadata['architecture'] = x.split(" ")[1]
+            if x.startswith('Classes'):
+                metadata['classes'] = int(x.split(" ")[1])
+    return metadata
+
+
+def read_metadata(path: str) -> dict:
+    '''
+    Reads only the metadata of a checkpoint, the weights are not deserialized.
+    For models saved as plain state_dict the .meta file next to it is parsed.
+    '''
+    with open(path, 'rb') as f:
+        metadata = _read_header(f)
+    if metadata is None:
+        metadata = _read_legacy_meta(path)
+    return metadata
+
+
+def load_checkpoint(path: str, map_location=None):
+    '''
+    Returns (metadata, state_dict) of a checkpoint. The metadata of a plain state_dict is read from the .meta file
+    next to it, or is empty if there is none (e.g. weights passed to continue training).
+    '''
+    with open(path, 'rb') as f:
+        metadata = _read_header(f)
+        if metadata is None:
+            f.seek(0)
+        state_dict = torch.load(io.BytesIO(f.read()), map_location=map_location)
+    if metadata is None:
+        try:
+            metadata = _read_legacy_meta(path)
+        except FileNotFoundError:
+            metadata = {}
+    return metadata, state_dict
+
+
+class AsyncCheckpointWriter(object):
+    '''
+    Writes checkpoints from a background thread. The weights are copied to the cpu before save returns,
+    so training can continue to update the model while the file is written.
+    If the previous checkpoint is still being written, save blocks until it is done.
+    '''
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                path, state_dict, metadata = item
+                try:
+                    save_checkpoint(path, state_dict, metadata)
+                except Exception as e:
+                    logger.warning('Could not save checkpoint {}: {}\n'.format(path, e))
+            finally:
+                # drop the weights before the next get, save waits for task_done to copy new ones
+                item = state_dict = None
+                self._queue.task_done()
+
+    def save(self, path: str, state_dict, metadata: dict):
+        # at most one cpu copy of the weights exists: the previous one is released before the next is made
+        self._queue.join()
+        state_dict = {k: v.detach().to('cpu', copy=True) for k, v in state_dict.items()}
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._queue.put((path, state_dict, metadata))
+
+    def wait(self):
+        self._queue.join()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,27 +1,22 @@
-import skimage
 from torch.utils.data import Dataset, DataLoader
 from PIL import Image
-import pandas as pd
 import os
 import numpy as np
-from albumentations import (HorizontalFlip, ShiftScaleRotate, Normalize, Resize, Compose, GaussNoise)
-from albumentations.pytorch.transforms import ToTensorV2, ToTensor
 import json
 from ast import literal_eval
 import random
-from matplotlib import pyplot as plt
-from typing import List
-from skimage.morphology import remove_small_holes
-from skimage.transform import rescale, resize
-import albumentations as albu
+from typing import List, TYPE_CHECKING
 import torch
 import gc
 from segmentation.util import gray_to_rgb, rgb2gray
-from pagexml_mask_converter.pagexml_to_mask import MaskGenerator, MaskSetting, BaseMaskGenerator, MaskType, PCGTSVersion
+from segmentation.dataset_index import DatasetIndex
 import math
-from segmentation.preprocessing.basic_binarizer import gauss_threshold
+from functools import lru_cache
 
-from segmentation.preprocessing.ocrupus import binarize
+# albumentations, pandas, skimage, matplotlib and pagexml_mask_converter are imported where they are used,
+# so predictors importing this module do not load them
+if TYPE_CHECKING:
+    from pagexml_mask_converter.pagexml_to_mask import BaseMaskGenerator
 
 
 # When training/testing/evaluationg on cpu set environment varialbe LRU_CACHE_CAPACITY=1
@@ -34,36 +29,72 @@ def to_categorical(y, num_classes, torch=True):
     return one_hot
 
 
-def color_to_label(mask, colormap: dict):
-    out = np.zeros(mask.shape[0:2], dtype=np.int32)
+def color_lookup_table(colormap: dict):
+    '''
+    returns the sorted packed rgb keys (256 * 256 * r + 256 * g + b) of the color map and their labels
+    '''
+    keys = np.array([256 * 256 * color[0] + 256 * color[1] + color[2] for color in colormap.keys()], dtype=np.uint32)
+    labels = np.array([label[0] for label in colormap.values()], dtype=np.int32)
+    order = np.argsort(keys)
+    return keys[order], labels[order]
+
 
+@lru_cache(maxsize=4)
+def _dense_color_lookup_table(colors: tuple):
+    # 2**24 entries, one uint8 label for every possible rgb color
+    table = np.zeros(256 * 256 * 256, dtype=np.uint8)
+    for color, label in colors:
+        table[256 * 256 * color[0] + 256 * color[1] + color[2]] = label
+    return table
+
+
+def color_to_label(mask, colormap: dict):
     if mask.ndim == 2:
         return mask.astype(np.int32) / 255
 
     if mask.shape[2] == 2:
         return mask[:, :, 0].astype(np.int32) / 255
-    mask = mask.astype(np.uint32)
-    mask = 256 * 256 * mask[:, :, 0] + 256 * mask[:, :, 1] + mask[:, :, 2]
-    for color, label in colormap.items():
-        color_1d = 256 * 256 * color[0] + 256 * color[1] + color[2]
-        out += (mask == color_1d) * label[0]
-    return out
+    mask = mask.astype(np.uint32, copy=False)
+    mask = (mask[:, :, 0] << 16) | (mask[:, :, 1] << 8) | mask[:, :, 2]
+    # colors which are not part of the color map are mapped to 0
+    if all(0 <= label[0] < 256 for label in colormap.values()):
+        table = _dense_color_lookup_table(tuple((tuple(color), label[0]) for color, label in colormap.items()))
+        return table[mask].astype(np.int32)
+    keys, labels = color_lookup_table(colormap)
+    index = np.minimum(np.searchsorted(keys, mask), len(keys) - 1)
+    return np.where(keys[index] == mask, labels[index], 0).astype(np.int32, copy=False)
 
 
 def label_to_colors(mask, colormap: dict):
-    out = np.zeros(mask.shape + (3,), dtype=np.int64)
+    mask = np.asarray(mask).astype(np.int64, copy=False)
+    n_labels = max([label[0] for label in colormap.values()], default=-1) + 1
+    # the last palette entry (black) is used for labels which are not part of the color map
+    palette = np.zeros((n_labels + 1, 3), dtype=np.uint8)
     for color, label in colormap.items():
-        trues = np.stack([(mask == label[0])] * 3, axis=-1)
-        out += np.tile(color, mask.shape + (1,)) * trues
-
-    out = np.ndarray.astype(out, dtype=np.uint8)
-    return out
+        palette[label[0]] = color
+    mask = np.where((mask >= 0) & (mask < n_labels), mask, n_labels)
+    return palette[mask]
 
 
 def rescale_pil(image, scale, order=1):
     return image.resize((int(image.size[0] * scale), int(image.size[1] * scale)), order)
 
 
+def decode_rescaled(image, order=1):
+    '''
+    Decodes an opened (not yet loaded) PIL image rescaled by get_rescale_factor and returns it with the factor.
+    JPEGs are decoded in the DCT domain at the smallest 1/2, 1/4 or 1/8 scale which is not below the target size
+    (Image.draft), so large scans are never decoded at full resolution. The exact resize to the size of
+    rescale_pil follows.
+    '''
+    rescale_factor = get_rescale_factor(image)
+    size = (int(image.size[0] * rescale_factor), int(image.size[1] * rescale_factor))
+    if rescale_factor < 1:
+        # no-op for other formats and already loaded images
+        image.draft(image.mode, size)
+    return image.resize(size, order), rescale_factor
+
+
 def default_preprocessing(x):
     return x / 255.
 
@@ -90,42 +121,59 @@ def process(image, mask, rgb, preprocessing, apply_preprocessing, augmentation,
 
     if augmentation is not None and binary_augmentation:
         from segmentation.preprocessing.basic_binarizer import gauss_threshold
-        from matplotlib import pyplot as plt
         ran = np.random.randint(1, 5)
         if ran == 1:
             image = rgb2gray(result["image"]).astype(np.uint8)
             result["image"] = gray_to_rgb(gauss_threshold(image))
-    if apply_preprocessing is not None and apply_preprocessing:
+    # without preprocessing, images stay uint8 (normalized on the device by gpu_augmentation)
+    if apply_preprocessing is not None and apply_preprocessing and preprocessing is not None:
         result["image"] = preprocessing(result["image"])
     result = compose([post_transforms()])(**result)
     return result["image"], result["mask"]
 
 
+def dataset_columns(df):
+    '''
+    images and masks of a DatasetIndex, or of a DataFrame as lists (indexing pandas columns per item is slow)
+    '''
+    if isinstance(df, DatasetIndex):
+        return df.images, df.masks
+    return df.get('images').tolist(), df.get('masks').tolist()
+
+
 class MaskDataset(Dataset):
     def __init__(self, df, color_map, preprocessing=default_preprocessing, transform=None, rgb=True):
         self.df = df
         self.color_map = color_map
         self.augmentation = transform
-        self.index = self.df.index.tolist()
+        self.images, self.masks = dataset_columns(df)
         self.preprocessing = preprocessing
         self.rgb = rgb
 
-    def __getitem__(self, item, apply_preprocessing=True):
-        image_id, mask_id = self.df.get('images')[item], self.df.get('masks')[item]
+    def load(self, item):
+        image_id, mask_id = self.images[item], self.masks[item]
 
-        image = Image.open(image_id)
+        image, rescale_factor = decode_rescaled(Image.open(image_id))
         mask = Image.open(mask_id)
-        rescale_factor = get_rescale_factor(image)
 
         mask = np.array(rescale_pil(mask, rescale_factor, 0))
-        image = np.array(rescale_pil(image, rescale_factor, 1))
+        image = np.array(image)
+        return image, mask
+
+    def page_size(self, item):
+        if isinstance(self.df, DatasetIndex):
+            return self.df.page_size(item)
+        return rescaled_size(self.images[item])
+
+    def __getitem__(self, item, apply_preprocessing=True):
+        image, mask = self.load(item)
         image, mask = process(image, mask, rgb=self.rgb, preprocessing=self.preprocessing,
                               apply_preprocessing=apply_preprocessing, augmentation=self.augmentation,
                               binary_augmentation=True, color_map=self.color_map)
         return image, mask, torch.tensor(item)
 
     def __len__(self):
-        return len(self.index)
+        return len(self.images)
 
 
 class MemoryDataset(Dataset):
@@ -133,12 +181,12 @@ class MemoryDataset(Dataset):
         self.df = df
         self.color_map = color_map
         self.augmentation = transform
-        self.index = self.df.index.tolist()
+        self.images, self.masks = dataset_columns(df)
         self.preprocessing = preprocessing
         self.rgb = rgb
 
     def __getitem__(self, item, apply_preprocessing=True):
-        image_id, mask_id = self.df.get('images')[item], self.df.get('masks')[item]
+        image_id, mask_id = self.images[item], self.masks[item]
 
         image = image_id
         mask = mask_id
@@ -149,29 +197,40 @@ class MemoryDataset(Dataset):
 
         return image, mask, torch.tensor(item)
 
+    def page_size(self, item):
+        return self.images[item].shape[:2]
+
     def __len__(self):
-        return len(self.index)
+        return len(self.images)
 
 
 class XMLDataset(Dataset):
-    def __init__(self, df, color_map, mask_generator: BaseMaskGenerator, preprocessing=default_preprocessing,
+    def __init__(self, df, color_map, mask_generator: 'BaseMaskGenerator', preprocessing=default_preprocessing,
                  transform=None, rgb=True):
         self.df = df
         self.color_map = color_map
         self.augmentation = transform
-        self.index = self.df.index.tolist()
+        self.images, self.masks = dataset_columns(df)
         self.preprocessing = preprocessing
         self.rgb = rgb
         self.mask_generator = mask_generator
 
-    def __getitem__(self, item, apply_preprocessing=True):
-        image_id, mask_id = self.df.get('images')[item], self.df.get('masks')[item]
+    def load(self, item):
+        image_id, mask_id = self.images[item], self.masks[item]
 
-        image = Image.open(image_id)
-        rescale_factor = get_rescale_factor(image)
+        image, rescale_factor = decode_rescaled(Image.open(image_id))
 
         mask = self.mask_generator.get_mask(mask_id, rescale_factor)
-        image = np.array(rescale_pil(image, rescale_factor, 1))
+        image = np.array(image)
+        return image, mask
+
+    def page_size(self, item):
+        if isinstance(self.df, DatasetIndex):
+            return self.df.page_size(item)
+        return rescaled_size(self.images[item])
+
+    def __getitem__(self, item, apply_preprocessing=True):
+        image, mask = self.load(item)
 
         image, mask = process(image, mask, rgb=self.rgb, preprocessing=self.preprocessing,
                               apply_preprocessing=apply_preprocessing, augmentation=self.augmentation,
@@ -179,26 +238,25 @@ class XMLDataset(Dataset):
         return image, mask, torch.tensor(item)
 
     def __len__(self):
-        return len(self.index)
+        return len(self.images)
 
 
 class PredictDataset(Dataset):
-    def __init__(self, df, color_map, mask_generator: BaseMaskGenerator, preprocessing=default_preprocessing,
+    def __init__(self, df, color_map, mask_generator: 'BaseMaskGenerator', preprocessing=default_preprocessing,
                  transform=None, rgb=True, pad_factor: int = 32):
         self.df = df
         self.color_map = color_map
-        self.index = self.df.index.tolist()
+        self.images, self.masks = dataset_columns(df)
         self.preprocessing = preprocessing
         self.rgb = rgb
         self.pad_factor = pad_factor
 
     def __getitem__(self, item, apply_preprocessing=True):
-        image_id, mask_id = self.df.get('images')[item], self.df.get('masks')[item]
+        image_id, mask_id = self.images[item], self.masks[item]
         l_factor = self.pad_factor
-        image = Image.open(image_id)
-        rescale_factor = get_rescale_factor(image)
+        image, rescale_factor = decode_rescaled(Image.open(image_id))
 
-        image = np.array(rescale_pil(image, rescale_factor, 1))
+        image = np.array(image)
         mask = image
         image, mask = process(image, mask, rgb=self.rgb, preprocessing=self.preprocessing,
                               apply_preprocessing=apply_preprocessing, augmentation=None, binary_augmentation=True,
@@ -206,7 +264,119 @@ class PredictDataset(Dataset):
         return image, mask, torch.tensor(item)
 
     def __len__(self):
-        return len(self.index)
+        return len(self.images)
+
+
+class PackedDataset(Dataset):
+    '''
+    Reads pages written by pack_dataset. Images and label masks are memory-mapped and sliced without copying,
+    so augmentation is the only per-sample work and DataLoader workers share the pages through the page cache.
+    '''
+
+    def __init__(self, path, preprocessing=default_preprocessing, transform=None, rgb=True):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.color_map = {literal_eval(k): v for k, v in self.meta['color_map'].items()} \
+            if self.meta['color_map'] is not None else None
+        self.entries = np.load(os.path.join(path, 'index.npy'))
+        self.augmentation = transform
+        self.preprocessing = preprocessing
+        self.rgb = rgb
+        self._images = None
+        self._masks = None
+
+    def _open(self):
+        # copy-on-write mappings: pages are shared until a transform writes into a slice
+        if self._images is None:
+            self._images = np.memmap(os.path.join(self.path, 'images.bin'), dtype=np.uint8, mode='c')
+            self._masks = np.memmap(os.path.join(self.path, 'masks.bin'), dtype=self.meta['mask_dtype'], mode='c')
+
+    def __getstate__(self):
+        # memory maps are opened lazily in every worker
+        state = self.__dict__.copy()
+        state['_images'] = None
+        state['_masks'] = None
+        return state
+
+    def load(self, item):
+        self._open()
+        entry = self.entries[item]
+        image_shape = (entry['height'], entry['width'], entry['channels']) if entry['channels'] > 0 \
+            else (entry['height'], entry['width'])
+        image_size = int(np.prod(image_shape))
+        mask_shape = (entry['mask_height'], entry['mask_width'])
+        image = self._images[entry['image_offset']:entry['image_offset'] + image_size].reshape(image_shape)
+        mask = self._masks[entry['mask_offset']:entry['mask_offset'] + int(np.prod(mask_shape))].reshape(mask_shape)
+        return image, mask
+
+    def page_size(self, item):
+        entry = self.entries[item]
+        return int(entry['height']), int(entry['width'])
+
+    def __getitem__(self, item, apply_preprocessing=True):
+        image, mask = self.load(item)
+        # masks are stored as labels, so no color map is needed
+        image, mask = process(image, mask, rgb=self.rgb, preprocessing=self.preprocessing,
+                              apply_preprocessing=apply_preprocessing, augmentation=self.augmentation,
+                              binary_augmentation=True, color_map=None)
+        return image, mask, torch.tensor(item)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+PACKED_INDEX_DTYPE = np.dtype([('image_offset', np.int64), ('mask_offset', np.int64),
+                               ('height', np.int32), ('width', np.int32), ('channels', np.int32),
+                               ('mask_height', np.int32), ('mask_width', np.int32)])
+
+
+# dataset of a pack_dataset worker, set once per worker by _init_pack_worker instead of being pickled per item
+_pack_dataset = None
+
+
+def _init_pack_worker(dataset):
+    global _pack_dataset
+    _pack_dataset = dataset
+
+
+def _load_labels(item):
+    dataset = _pack_dataset
+    image, mask = dataset.load(item)
+    if dataset.color_map and mask.ndim == 3:
+        mask = color_to_label(mask, dataset.color_map)
+    return image, mask
+
+
+def pack_dataset(dataset, path, processes=4, chunksize=16):
+    '''
+    Writes the rescaled images and label masks of a MaskDataset or XMLDataset to path:
+    images.bin and masks.bin hold the raw arrays back to back, index.npy their offsets and shapes
+    and meta.json the color map. Read the result with PackedDataset.
+    '''
+    import multiprocessing
+    os.makedirs(path, exist_ok=True)
+    color_map = dataset.color_map
+    mask_dtype = np.uint8 if not color_map or max(v[0] for v in color_map.values()) < 256 else np.int32
+    entries = np.zeros(len(dataset), dtype=PACKED_INDEX_DTYPE)
+    image_offset = 0
+    mask_offset = 0
+    with open(os.path.join(path, 'images.bin'), 'wb') as images, \
+            open(os.path.join(path, 'masks.bin'), 'wb') as masks, \
+            multiprocessing.Pool(processes=processes, initializer=_init_pack_worker, initargs=(dataset,)) as p:
+        for ind, (image, mask) in enumerate(p.imap(_load_labels, range(len(dataset)), chunksize=chunksize)):
+            image = np.ascontiguousarray(image, dtype=np.uint8)
+            mask = np.ascontiguousarray(mask, dtype=mask_dtype)
+            entries[ind] = (image_offset, mask_offset, image.shape[0], image.shape[1],
+                            image.shape[2] if image.ndim == 3 else 0, mask.shape[0], mask.shape[1])
+            images.write(image.tobytes())
+            masks.write(mask.tobytes())
+            image_offset += image.size
+            mask_offset += mask.size
+    np.save(os.path.join(path, 'index.npy'), entries)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'color_map': {str(k): v for k, v in color_map.items()} if color_map else None,
+                   'mask_dtype': np.dtype(mask_dtype).name}, f)
 
 
 def get_rescale_factor(pil_image):
@@ -216,6 +386,15 @@ def get_rescale_factor(pil_image):
     return rescale_factor
 
 
+def rescaled_size(image_path):
+    '''
+    (height, width) of the image after rescaling, only the image header is read
+    '''
+    with Image.open(image_path) as image:
+        rescale_factor = get_rescale_factor(image)
+        return int(image.size[1] * rescale_factor), int(image.size[0] * rescale_factor)
+
+
 def listdir(dir, postfix="", not_postfix=False):
     if dir is None:
         return None
@@ -226,6 +405,10 @@ def listdir(dir, postfix="", not_postfix=False):
 
 
 def dirs_to_pandaframe(images_dir: List[str], masks_dir: List[str], verify_filenames: bool = True):
+    '''
+    see dataset_index.index_dirs for large datasets
+    '''
+    import pandas as pd
     img = []
     m = []
     for img_d, mask_d in zip(images_dir, masks_dir):
@@ -264,10 +447,12 @@ def load_image_map_from_file(path):
 
 
 def pre_transforms(image_size=224):
+    import albumentations as albu
     return [albu.Resize(image_size, image_size, p=1)]
 
 
 def hard_transforms():
+    import albumentations as albu
     result = [
         # albu.RandomRotate90(),
         albu.CoarseDropout(),
@@ -281,6 +466,7 @@ def hard_transforms():
 
 
 def base_line_transform():
+    import albumentations as albu
     result = [
         albu.HorizontalFlip(),
         albu.RandomGamma(),
@@ -294,6 +480,7 @@ def base_line_transform():
 
 
 def resize_transforms(image_size=480):
+    import albumentations as albu
     BORDER_CONSTANT = 0
     pre_size = int(image_size * 1.5)
 
@@ -328,12 +515,14 @@ def resize_transforms(image_size=480):
 
 
 def post_transforms():
+    from albumentations.pytorch.transforms import ToTensorV2
     # we use ImageNet image normalization
     # and convert it to torch.Tensor
     return [ToTensorV2()]
 
 
 def compose(transforms_to_compose):
+    import albumentations as albu
     # combine all augmentations into one single pipeline
     # convenient if ypu want to add extra targets, e.g. binary input
     result = albu.Compose([
@@ -343,6 +532,7 @@ def compose(transforms_to_compose):
 
 
 def show_examples(name: str, image: np.ndarray, binary: np.ndarray, mask: np.ndarray):
+    from matplotlib import pyplot as plt
     foreground = np.stack([(binary)] * 3, axis=-1)
     inv_binary = 1 - binary
     inv_binary = np.stack([inv_binary] * 3, axis=-1)
@@ -366,6 +556,7 @@ def show_examples(name: str, image: np.ndarray, binary: np.ndarray, mask: np.nda
 
 
 def show(index: int, image, mask, transforms=None) -> None:
+    from skimage.morphology import remove_small_holes
     image = Image.open(image)
     image = np.asarray(image)
     mask = np.array(Image.open(mask))
@@ -383,6 +574,7 @@ def show(index: int, image, mask, transforms=None) -> None:
 
 
 def show_random(df, transforms=None) -> None:
+    from matplotlib import pyplot as plt
     length = len(df)
     index = random.randint(0, length - 1)
     image = df.get('images')[index]
@@ -455,6 +647,7 @@ def track():
 
 if __name__ == '__main__':
     'https://github.com/catalyst-team/catalyst/blob/master/examples/notebooks/segmentation-tutorial.ipynb'
+    from pagexml_mask_converter.pagexml_to_mask import MaskGenerator, MaskSetting, MaskType, PCGTSVersion
     a = dirs_to_pandaframe(
         ['/home/alexander/Dokumente/dataset/READ-ICDAR2019-cBAD-dataset/train/image/'],
         ['/home/alexander/Dokumente/dataset/READ-ICDAR2019-cBAD-dataset/train/page/'])
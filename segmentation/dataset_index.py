@@ -0,0 +1,222 @@
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 2
+
+
+def rescale_factors(widths: np.ndarray, heights: np.ndarray) -> np.ndarray:
+    '''
+    Vectorized dataset.get_rescale_factor: pages with more than 1M pixels are scaled down to 1M pixels
+    '''
+    pixels = widths.astype(np.float64) * heights.astype(np.float64)
+    return np.where(pixels >= 1000000, np.sqrt(1000000 / np.maximum(pixels, 1)), 1.0)
+
+
+class PathArray(object):
+    '''
+    Paths stored as directory ids and fixed width encoded file names, indexable like a list of str.
+    A million paths take a few ten MB and are pickled to DataLoader workers as two buffers.
+    '''
+
+    def __init__(self, directories: List[str], directory_ids: np.ndarray, names: np.ndarray):
+        self.directories = list(directories)
+        self.directory_ids = directory_ids
+        self.names = names
+
+    def __getitem__(self, item):
+        if isinstance(item, (slice, list, np.ndarray)):
+            return PathArray(self.directories, self.directory_ids[item], self.names[item])
+        return os.path.join(self.directories[self.directory_ids[item]], os.fsdecode(self.names[item]))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def tolist(self) -> List[str]:
+        return list(self)
+
+
+class DatasetIndex(object):
+    '''
+    Paired image and mask paths with the file size, modification time, dimensions and rescale factor
+    of every image.
+    Can be passed to the datasets in place of the DataFrame of dirs_to_pandaframe.
+    '''
+
+    def __init__(self, images: PathArray, masks: PathArray, sizes: np.ndarray, mtimes: np.ndarray,
+                 widths: np.ndarray, heights: np.ndarray):
+        if len(images) != len(masks):
+            raise ValueError('{} images but {} masks'.format(len(images), len(masks)))
+        self.images = images
+        self.masks = masks
+        self.sizes = sizes
+        self.mtimes = mtimes
+        self.widths = widths
+        self.heights = heights
+        self.rescale_factors = rescale_factors(widths, heights)
+
+    def get(self, column: str):
+        return {'images': self.images, 'masks': self.masks}.get(column)
+
+    def page_size(self, item):
+        '''
+        (height, width) of the image after rescaling, as returned by dataset.rescaled_size
+        '''
+        rescale_factor = float(self.rescale_factors[item])
+        return int(int(self.heights[item]) * rescale_factor), int(int(self.widths[item]) * rescale_factor)
+
+    def __getitem__(self, item):
+        return DatasetIndex(self.images[item], self.masks[item], self.sizes[item], self.mtimes[item],
+                            self.widths[item], self.heights[item])
+
+    def __len__(self):
+        return len(self.images)
+
+
+def _scan(directory: str):
+    # is_file uses the file type returned with the directory entry, no stat call per file
+    return sorted(entry.name for entry in os.scandir(directory) if entry.is_file())
+
+
+def _image_info(args):
+    from PIL import Image
+    path, previous = args
+    stat = os.stat(path)
+    if previous is not None and previous[:2] == (stat.st_size, stat.st_mtime_ns):
+        return previous, False
+    with Image.open(path) as image:
+        width, height = image.size
+    return (stat.st_size, stat.st_mtime_ns, width, height), True
+
+
+def _directory_mtimes(directories: List[str]) -> np.ndarray:
+    return np.array([os.stat(d).st_mtime_ns for d in directories], dtype=np.int64)
+
+
+def _encode(names: List[str]) -> np.ndarray:
+    return np.array([os.fsencode(n) for n in names], dtype=bytes) if len(names) > 0 else np.zeros(0, dtype='S1')
+
+
+def manifest_path(cache_dir: str, images_dir: List[str], masks_dir: List[str]) -> str:
+    '''
+    Manifest file in cache_dir for the given folders
+    '''
+    key = '\n'.join(os.path.abspath(d) for d in list(images_dir) + ['|'] + list(masks_dir))
+    return os.path.join(cache_dir, 'index-{}.npz'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+
+
+def _pair(directories: List[str], names: List[List[str]], n_images: int, verify_filenames: bool):
+    def entries(dirs):
+        return [(d, name) for d in dirs for name in names[d]]
+
+    images = entries(range(n_images))
+    masks = entries(range(n_images, len(directories)))
+    if verify_filenames:
+        # same pairing as dirs_to_pandaframe: the last file of a basename wins
+        def by_basename(x):
+            return {name.split('.')[0]: (d, name) for d, name in x}
+
+        images, masks = by_basename(images), by_basename(masks)
+        base_names = sorted(set(images.keys()).intersection(set(masks.keys())))
+        images = [images[b] for b in base_names]
+        masks = [masks[b] for b in base_names]
+    elif len(images) != len(masks):
+        raise ValueError('{} images but {} masks'.format(len(images), len(masks)))
+
+    def path_array(x):
+        return PathArray(directories, np.array([d for d, _ in x], dtype=np.int32),
+                         _encode([name for _, name in x]))
+
+    return path_array(images), path_array(masks)
+
+
+def _load_manifest(path: str, directories: List[str], n_images: int, verify_filenames: bool):
+    '''
+    Returns (index, up_to_date) of a manifest written for the same folders, None otherwise
+    '''
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            data = dict(data)
+        if int(data['version']) != MANIFEST_VERSION or data['directories'].tolist() != directories \
+                or int(data['n_images']) != n_images or bool(data['verify_filenames']) != verify_filenames:
+            return None
+        index = DatasetIndex(PathArray(directories, data['image_directory_ids'], data['image_names']),
+                             PathArray(directories, data['mask_directory_ids'], data['mask_names']),
+                             data['sizes'], data['mtimes'], data['widths'], data['heights'])
+        directory_mtimes = data['directory_mtimes']
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning('Ignoring unreadable dataset manifest {}: {!r}\n'.format(path, e))
+        return None
+    # adding, removing or renaming files changes the mtime of the folder, rewriting a file in place does not
+    up_to_date = np.array_equal(directory_mtimes, _directory_mtimes(directories))
+    return index, up_to_date
+
+
+def _save_manifest(path: str, index: DatasetIndex, directories: List[str], n_images: int,
+                   verify_filenames: bool, directory_mtimes: np.ndarray):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, version=MANIFEST_VERSION, directories=np.array(directories, dtype=str), n_images=n_images,
+                 verify_filenames=verify_filenames, directory_mtimes=directory_mtimes,
+                 image_directory_ids=index.images.directory_ids, image_names=index.images.names,
+                 mask_directory_ids=index.masks.directory_ids, mask_names=index.masks.names,
+                 sizes=index.sizes, mtimes=index.mtimes, widths=index.widths, heights=index.heights,
+                 rescale_factors=index.rescale_factors)
+    os.replace(tmp_path, path)
+
+
+def index_dirs(images_dir: List[str], masks_dir: List[str], verify_filenames: bool = True, manifest: str = None,
+               threads: int = 16) -> DatasetIndex:
+    '''
+    Replacement of dirs_to_pandaframe for large corpora. The folders are listed with os.scandir and the image
+    headers are read by a thread pool. With manifest, the result is written to that .npz file and loaded from it
+    as long as no file was added to or removed from the folders. Images whose path, file size and modification time
+    are unchanged are not reopened when the index is rebuilt.
+    '''
+    pairs = list(zip(images_dir, masks_dir))
+    directories = [i for i, _ in pairs] + [m for _, m in pairs]
+    n_images = len(pairs)
+
+    previous = None
+    if manifest is not None and os.path.exists(manifest):
+        loaded = _load_manifest(manifest, directories, n_images, verify_filenames)
+        if loaded is not None:
+            previous, up_to_date = loaded
+            if up_to_date:
+                logger.info('Loaded dataset index of {} pages from {}\n'.format(len(previous), manifest))
+                return previous
+
+    # mtimes are taken before listing, so files added during the scan invalidate the manifest
+    directory_mtimes = _directory_mtimes(directories)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        names = list(pool.map(_scan, directories))
+        images, masks = _pair(directories, names, n_images, verify_filenames)
+
+        known = {}
+        if previous is not None:
+            known = {p: (int(s), int(m), int(w), int(h)) for p, s, m, w, h in
+                     zip(previous.images, previous.sizes, previous.mtimes, previous.widths, previous.heights)}
+        paths = images.tolist()
+        infos = list(pool.map(_image_info, [(p, known.get(p)) for p in paths]))
+    sizes = np.array([info[0] for info, _ in infos], dtype=np.int64)
+    mtimes = np.array([info[1] for info, _ in infos], dtype=np.int64)
+    widths = np.array([info[2] for info, _ in infos], dtype=np.int32)
+    heights = np.array([info[3] for info, _ in infos], dtype=np.int32)
+    index = DatasetIndex(images, masks, sizes, mtimes, widths, heights)
+    logger.info('Indexed {} pages ({} image headers read)\n'.format(len(index), sum(read for _, read in infos)))
+    if manifest is not None:
+        _save_manifest(manifest, index, directories, n_images, verify_filenames, directory_mtimes)
+    return index
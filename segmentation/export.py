@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+from enum import Enum
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+METADATA_KEY = 'segmentation_metadata'
+
+
+class ExportFormat(Enum):
+    TORCHSCRIPT = 'torchscript'
+    ONNX = 'onnx'
+
+    @property
+    def extension(self):
+        return '.' + self.value
+
+    @staticmethod
+    def from_path(path: str):
+        '''
+        Returns the export format of a model file, None for checkpoints
+        '''
+        extension = os.path.splitext(path)[1].lower()
+        for x in ExportFormat:
+            if x.extension == extension:
+                return x
+        return None
+
+
+def prepare_for_export(model):
+    model.eval()
+    # the memory efficient swish of efficientnet encoders is a custom autograd function, which cannot be traced
+    if hasattr(model, 'encoder') and hasattr(model.encoder, 'set_swish'):
+        model.encoder.set_swish(memory_efficient=False)
+    return model
+
+
+def export_torchscript(model, path: str, metadata: dict, example_size=(512, 512), optimize=True):
+    '''
+    Traces the model on the cpu and saves it as TorchScript. With optimize, the graph is frozen
+    (BatchNorm is folded into the preceding convolutions) and conv/add/relu chains are fused for cpu inference.
+    '''
+    model = prepare_for_export(model.cpu())
+    example = torch.zeros((1, 3) + tuple(example_size))
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example, check_trace=False)
+        if optimize:
+            traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    torch.jit.save(traced, path, _extra_files={METADATA_KEY: json.dumps(metadata)})
+
+
+def export_onnx(model, path: str, metadata: dict, example_size=(512, 512), opset_version=13):
+    '''
+    Exports the model with dynamic batch size, height and width to ONNX. Constant folding folds BatchNorm,
+    further fusions are applied by onnxruntime when the model is loaded.
+    '''
+    import onnx
+    model = prepare_for_export(model.cpu())
+    example = torch.zeros((1, 3) + tuple(example_size))
+    dynamic_axes = {0: 'batch', 2: 'height', 3: 'width'}
+    with torch.no_grad():
+        torch.onnx.export(model, example, path, input_names=['input'], output_names=['output'],
+                          dynamic_axes={'input': dynamic_axes, 'output': dynamic_axes},
+                          opset_version=opset_version, do_constant_folding=True)
+    onnx_model = onnx.load(path)
+    entry = onnx_model.metadata_props.add()
+    entry.key = METADATA_KEY
+    entry.value = json.dumps(metadata)
+    onnx.save(onnx_model, path)
+
+
+class OnnxModel(object):
+    '''
+    Runs an exported ONNX model with onnxruntime on the cpu, called like the torch model
+    '''
+
+    def __init__(self, path: str, threads: int = None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, sess_options=options,
+                                                    providers=['CPUExecutionProvider'])
+        self.metadata = json.loads(self.session.get_modelmeta().custom_metadata_map[METADATA_KEY])
+
+    def __call__(self, input):
+        output = self.session.run(None, {'input': input.detach().cpu().float().contiguous().numpy()})[0]
+        return torch.from_numpy(output)
+
+    def eval(self):
+        return self
+
+    def to(self, *args, **kwargs):
+        return self
+
+
+def load_exported(path: str, threads: int = None):
+    '''
+    Returns (metadata, model) of an exported model. The model runs on the cpu.
+    '''
+    if threads:
+        torch.set_num_threads(threads)
+    export_format = ExportFormat.from_path(path)
+    if export_format is ExportFormat.TORCHSCRIPT:
+        extra_files = {METADATA_KEY: ''}
+        model = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+        model.eval()
+        return json.loads(extra_files[METADATA_KEY]), model
+    elif export_format is ExportFormat.ONNX:
+        model = OnnxModel(path, threads=threads)
+        return model.metadata, model
+    raise ValueError('Not an exported model: {}'.format(path))
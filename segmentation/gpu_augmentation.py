@@ -0,0 +1,171 @@
+import logging
+import math
+from typing import Tuple
+
+import torch
+import torch.nn.functional as F
+
+from segmentation.sampler import IGNORE_INDEX
+
+logger = logging.getLogger(__name__)
+
+# weights of cv2.COLOR_RGB2GRAY, used by albumentations ToGray
+GRAY_WEIGHTS = (0.299, 0.587, 0.114)
+
+
+def _gaussian_kernel(size: int, device) -> torch.Tensor:
+    # sigma of cv2.getGaussianKernel(size, -1), as used by cv2.adaptiveThreshold
+    sigma = 0.3 * ((size - 1) * 0.5 - 1) + 0.8
+    x = torch.arange(size, dtype=torch.float32, device=device) - (size - 1) / 2
+    kernel = torch.exp(-x ** 2 / (2 * sigma ** 2))
+    return kernel / kernel.sum()
+
+
+def to_gray(images: torch.Tensor) -> torch.Tensor:
+    '''
+    (B, 1, H, W) luminance of (B, 3, H, W) images
+    '''
+    weights = torch.tensor(GRAY_WEIGHTS, dtype=images.dtype, device=images.device).view(1, 3, 1, 1)
+    return (images * weights).sum(dim=1, keepdim=True)
+
+
+def replicate_padding(images: torch.Tensor, padding: torch.Tensor) -> torch.Tensor:
+    '''
+    Replaces the padded pixels of every page of (B, C, H, W) images by its nearest edge pixels, as if each page
+    was extended with border replication. padding is the (B, H, W) mask of padded pixels around a rectangular page.
+    '''
+    b, _, h, w = images.shape
+    valid = ~padding
+    rows, columns = valid.any(dim=2), valid.any(dim=1)
+    positions_y = torch.arange(h, device=images.device).expand(b, h)
+    positions_x = torch.arange(w, device=images.device).expand(b, w)
+
+    def extent(valid_positions, positions, size):
+        first = torch.where(valid_positions, positions, torch.full_like(positions, size)).min(dim=1).values
+        last = torch.where(valid_positions, positions, torch.full_like(positions, -1)).max(dim=1).values
+        return torch.max(torch.min(positions, last.unsqueeze(1)), first.unsqueeze(1))
+
+    ys = extent(rows, positions_y, h)
+    xs = extent(columns, positions_x, w)
+    batch = torch.arange(b, device=images.device).view(-1, 1, 1)
+    # advanced indexing moves the indexed dimensions first: (B, H, W, C)
+    return images.permute(0, 2, 3, 1)[batch, ys.unsqueeze(2), xs.unsqueeze(1)].permute(0, 3, 1, 2)
+
+
+def gauss_threshold(gray: torch.Tensor, block_size: int = 35, offset: int = 40) -> torch.Tensor:
+    '''
+    Batched preprocessing.basic_binarizer.gauss_threshold of (B, 1, H, W) gray images in 0..255
+    '''
+    kernel = _gaussian_kernel(block_size, gray.device)
+    padding = block_size // 2
+    mean = F.pad(gray, (padding, padding, padding, padding), mode='replicate')
+    mean = F.conv2d(mean, kernel.view(1, 1, 1, -1))
+    mean = F.conv2d(mean, kernel.view(1, 1, -1, 1))
+    return (gray.floor() > mean.round() - offset).to(gray.dtype) * 255.
+
+
+def normalize(images: torch.Tensor, params: dict) -> torch.Tensor:
+    '''
+    The preprocessing of segmentation_models_pytorch (encoders.get_preprocessing_fn) on (B, C, H, W) tensors
+    '''
+    if params.get('input_space') == 'BGR':
+        images = images.flip(1)
+    if params.get('input_range') is not None and max(params['input_range']) == 1:
+        images = images / 255.
+    if params.get('mean') is not None:
+        images = images - torch.tensor(params['mean'], dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+    if params.get('std') is not None:
+        images = images / torch.tensor(params['std'], dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+    return images
+
+
+class BatchAugmentation(object):
+    '''
+    Augments collated batches on the training device, replacing the per-sample albumentations pipeline
+    (and the random gauss_threshold binarization) of process in the DataLoader workers.
+    Expects unnormalized (B, 3, H, W) images in 0..255 and (B, H, W) label masks and returns the normalized images
+    and masks. Random parameters are drawn per page, the scale per batch, so the pages of a batch keep a common size.
+    Probabilities and limits default to those of dataset.base_line_transform.
+    '''
+
+    def __init__(self, preprocessing_params: dict = None, flip_p: float = 0.5,
+                 gamma_limit: Tuple[float, float] = (80, 120), gamma_p: float = 0.5,
+                 brightness_limit: float = 0.2, contrast_limit: float = 0.2, brightness_contrast_p: float = 0.5,
+                 gray_p: float = 0.25, scale_limit: float = 0.1, scale_p: float = 0.5,
+                 binarize_p: float = 0.25):
+        self.preprocessing_params = preprocessing_params
+        self.flip_p = flip_p
+        self.gamma_limit = gamma_limit
+        self.gamma_p = gamma_p
+        self.brightness_limit = brightness_limit
+        self.contrast_limit = contrast_limit
+        self.brightness_contrast_p = brightness_contrast_p
+        self.gray_p = gray_p
+        self.scale_limit = scale_limit
+        self.scale_p = scale_p
+        self.binarize_p = binarize_p
+
+    @staticmethod
+    def _uniform(n, low, high, device):
+        return torch.rand(n, device=device) * (high - low) + low
+
+    @staticmethod
+    def _where(condition, a, b):
+        return torch.where(condition.view(-1, *([1] * (a.dim() - 1))), a, b)
+
+    def __call__(self, images: torch.Tensor, masks: torch.Tensor):
+        padding = masks == IGNORE_INDEX
+        images = images.float()
+        n = images.shape[0]
+        device = images.device
+
+        flip = torch.rand(n, device=device) < self.flip_p
+        images = self._where(flip, images.flip(-1), images)
+        masks = self._where(flip, masks.flip(-1), masks)
+        padding = self._where(flip, padding.flip(-1), padding)
+
+        if self.gamma_p > 0:
+            gamma = self._uniform(n, self.gamma_limit[0] / 100, self.gamma_limit[1] / 100, device)
+            gamma = torch.where(torch.rand(n, device=device) < self.gamma_p, gamma, torch.ones_like(gamma))
+            images = 255. * (images / 255.).pow(gamma.view(-1, 1, 1, 1))
+
+        if self.brightness_contrast_p > 0:
+            apply = torch.rand(n, device=device) < self.brightness_contrast_p
+            alpha = 1. + self._uniform(n, -self.contrast_limit, self.contrast_limit, device)
+            beta = self._uniform(n, -self.brightness_limit, self.brightness_limit, device) * 255.
+            alpha = torch.where(apply, alpha, torch.ones_like(alpha))
+            beta = torch.where(apply, beta, torch.zeros_like(beta))
+            images = (images * alpha.view(-1, 1, 1, 1) + beta.view(-1, 1, 1, 1)).clamp(0., 255.)
+
+        if self.gray_p > 0:
+            gray = torch.rand(n, device=device) < self.gray_p
+            images = self._where(gray, to_gray(images).expand_as(images), images)
+
+        if self.scale_p > 0 and float(torch.rand(1)) < self.scale_p:
+            scale = 1. + float(torch.empty(1).uniform_(-self.scale_limit, self.scale_limit))
+            size = [max(1, int(math.floor(x * scale))) for x in images.shape[2:]]
+            images = F.interpolate(images, size=size, mode='bilinear', align_corners=False)
+            masks = F.interpolate(masks.unsqueeze(1).float(), size=size, mode='nearest').squeeze(1).to(masks.dtype)
+            padding = masks == IGNORE_INDEX
+
+        if self.binarize_p > 0:
+            binarize = torch.rand(n, device=device) < self.binarize_p
+            # the local mean of pages smaller than the batch must not see the zero padding of pad_collate
+            gray = replicate_padding(to_gray(images), padding)
+            images = self._where(binarize, gauss_threshold(gray).expand_as(images), images)
+
+        if self.preprocessing_params is not None:
+            images = normalize(images, self.preprocessing_params)
+        else:
+            images = images / 255.
+        # padded pixels are 0 after preprocessing, like pages padded by pad_collate on the cpu
+        images = images.masked_fill(padding.unsqueeze(1), 0.)
+        return images, masks
+
+
+def base_line_augmentation(preprocessing_params: dict = None) -> BatchAugmentation:
+    '''
+    Batched dataset.base_line_transform. CLAHE, one of the two choices of its OneOf, has no batched counterpart,
+    so the other one (ToGray) is applied with half of the OneOf probability.
+    '''
+    return BatchAugmentation(preprocessing_params)
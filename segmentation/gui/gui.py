@@ -6,7 +6,6 @@ from typing import Tuple, List
 import os
 from enum import Enum
 import threading
-import numpy as np
 from itertools import chain
 from shapely.geometry import LineString, box
 from segmentation.util import multiple_file_types
@@ -194,12 +193,9 @@ class Controller:
         probmap, scale_factor = self.network.predict_single_image_by_path(filename)
         baselines = extraxct_baselines_from_probability_map(probmap)
         if baselines and len(baselines) > 0:
-            for ind, baseline in enumerate(baselines):
-                from segmentation.postprocessing.simplify_line import VWSimplifier
-                simplifier = VWSimplifier(np.asarray(baseline, dtype=np.float64))
-                np_baseline = simplifier.from_number(5)
-                baselines[ind] = list(np_baseline)
-                pass
+            from segmentation.postprocessing.simplify_line import VWBatchSimplifier
+            simplifier = VWBatchSimplifier.from_lines(baselines)
+            baselines = [list(np_baseline) for np_baseline in simplifier.from_number(5)]
         else:
             baselines = []
 
@@ -0,0 +1,131 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# part of every key, increment when the encoding of cached masks changes
+CACHE_VERSION = 1
+
+
+class CachedMaskGenerator(object):
+    '''
+    Wraps a MaskGenerator and caches the rendered masks. The key is the sha1 of the xml file content,
+    the rescale factor and the mask settings, so changing e.g. LINEWIDTH or BASELINELENGTH never returns stale masks.
+    Masks are stored as PNG (compression level 1, uint8) or npy files in cache_dir and the encoded bytes
+    of the most recently used ones are kept in memory, up to memory_bytes. Every DataLoader worker has its own
+    memory tier, the files in cache_dir are shared between workers and runs.
+    '''
+
+    def __init__(self, mask_generator, cache_dir: str = None, memory_bytes: int = 512 * 1024 * 1024, settings=None):
+        self.mask_generator = mask_generator
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        settings = settings if settings is not None else getattr(mask_generator, 'settings', None)
+        if settings is None:
+            raise ValueError('The mask settings of {} are unknown, pass them as settings'.format(mask_generator))
+        self.settings_key = repr(settings)
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # workers start with an empty memory tier
+        state = self.__dict__.copy()
+        state['_memory'] = OrderedDict()
+        state['_memory_size'] = 0
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def key(self, xml: bytes, rescale_factor: float) -> str:
+        h = hashlib.sha1(xml)
+        h.update('|{!r}|{}|{}'.format(float(rescale_factor), self.settings_key, CACHE_VERSION).encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key: str, extension: str):
+        return os.path.join(self.cache_dir, key[:2], key + extension)
+
+    def _remember(self, key: str, data):
+        with self._lock:
+            if key in self._memory:
+                return
+            self._memory[key] = data
+            self._memory_size += len(data[1])
+            while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+                _, (_, evicted) = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def _lookup(self, key: str):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+        if self.cache_dir is None:
+            return None
+        for extension in ('.png', '.npy'):
+            try:
+                with open(self._path(key, extension), 'rb') as f:
+                    data = (extension, f.read())
+            except FileNotFoundError:
+                continue
+            self._remember(key, data)
+            return data
+        return None
+
+    def _store(self, key: str, data):
+        self._remember(key, data)
+        if self.cache_dir is None:
+            return
+        extension, encoded = data
+        path = self._path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # unique tmp file per process and thread, concurrent writers of the same mask write identical content
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(encoded)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def encode(mask: np.ndarray):
+        if mask.dtype == np.uint8 and (mask.ndim == 2 or (mask.ndim == 3 and mask.shape[2] in (3, 4))):
+            from PIL import Image
+            buffer = io.BytesIO()
+            Image.fromarray(mask).save(buffer, format='PNG', compress_level=1)
+            return '.png', buffer.getvalue()
+        buffer = io.BytesIO()
+        np.save(buffer, mask, allow_pickle=False)
+        return '.npy', buffer.getvalue()
+
+    @staticmethod
+    def decode(data) -> np.ndarray:
+        extension, encoded = data
+        if extension == '.png':
+            from PIL import Image
+            return np.array(Image.open(io.BytesIO(encoded)))
+        return np.load(io.BytesIO(encoded), allow_pickle=False)
+
+    def get_mask(self, path: str, rescale_factor: float) -> np.ndarray:
+        with open(path, 'rb') as f:
+            key = self.key(f.read(), rescale_factor)
+        data = self._lookup(key)
+        if data is not None:
+            self.hits += 1
+            return self.decode(data)
+        self.misses += 1
+        mask = self.mask_generator.get_mask(path, rescale_factor)
+        self._store(key, self.encode(np.asarray(mask)))
+        return mask
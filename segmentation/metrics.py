@@ -0,0 +1,95 @@
+from enum import Enum
+
+import numpy as np
+import torch
+
+from segmentation.sampler import IGNORE_INDEX
+
+
+class RunningMetrics(object):
+    '''
+    Accumulates loss and pixel accuracy on the device. Values are only transferred
+    to the host (forcing a device sync) when they are read. Padded pixels (IGNORE_INDEX) are not counted.
+    '''
+
+    def __init__(self, device):
+        self.loss_sum = torch.zeros((), device=device)
+        self.correct = torch.zeros((), dtype=torch.int64, device=device)
+        self.total = torch.zeros((), dtype=torch.int64, device=device)
+        self.n_batches = 0
+
+    def update(self, loss, predicted, target):
+        self.loss_sum += loss.detach().float()
+        valid = target != IGNORE_INDEX
+        self.correct += (predicted.eq(target) & valid).sum()
+        self.total += valid.sum()
+        self.n_batches += 1
+
+    def loss(self):
+        return self.loss_sum.item() / max(self.n_batches, 1)
+
+    def accuracy(self):
+        return 100. * self.correct.item() / max(self.total.item(), 1)
+
+
+class Metric(Enum):
+    ACCURACY = 'accuracy'
+    LOSS = 'loss'
+    MEAN_IOU = 'mean_iou'
+    MEAN_F1 = 'mean_f1'
+    BASELINE_PRECISION = 'baseline_precision'
+    BASELINE_RECALL = 'baseline_recall'
+    BASELINE_F1 = 'baseline_f1'
+
+    def better(self, value, best):
+        if best is None:
+            return True
+        return value < best if self is Metric.LOSS else value > best
+
+
+class ConfusionMatrix(object):
+    '''
+    Per-class confusion matrix (rows: target, columns: prediction) accumulated on the device
+    with a single bincount per batch. The loss is weighted by the number of valid pixels of a batch,
+    so padded batches of different sizes are averaged correctly.
+    '''
+
+    def __init__(self, n_classes, device, baseline_class=1):
+        self.n_classes = n_classes
+        self.baseline_class = baseline_class
+        self.matrix = torch.zeros((n_classes, n_classes), dtype=torch.int64, device=device)
+        self.loss_sum = torch.zeros((), device=device)
+
+    def update(self, predicted, target, loss=None):
+        valid = (target >= 0) & (target < self.n_classes)
+        index = target[valid] * self.n_classes + predicted[valid]
+        self.matrix += torch.bincount(index, minlength=self.n_classes ** 2).view(self.n_classes, self.n_classes)
+        if loss is not None:
+            self.loss_sum += loss.detach().float() * valid.sum()
+
+    def compute(self):
+        matrix = self.matrix.double().cpu().numpy()
+        true_positives = np.diag(matrix)
+        support = matrix.sum(axis=1)
+        predicted = matrix.sum(axis=0)
+        total = max(matrix.sum(), 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            iou = true_positives / (support + predicted - true_positives)
+            precision = true_positives / predicted
+            recall = true_positives / support
+            f1 = 2 * true_positives / (support + predicted)
+        # classes neither present nor predicted do not count towards the means
+        result = {
+            Metric.ACCURACY.value: 100. * true_positives.sum() / total,
+            Metric.LOSS.value: self.loss_sum.item() / total,
+            Metric.MEAN_IOU.value: float(np.nanmean(iou)) if not np.all(np.isnan(iou)) else 0.,
+            Metric.MEAN_F1.value: float(np.nanmean(f1)) if not np.all(np.isnan(f1)) else 0.,
+            'iou': np.nan_to_num(iou).tolist(),
+            'f1': np.nan_to_num(f1).tolist(),
+        }
+        if self.baseline_class < self.n_classes:
+            b = self.baseline_class
+            result[Metric.BASELINE_PRECISION.value] = float(np.nan_to_num(precision[b]))
+            result[Metric.BASELINE_RECALL.value] = float(np.nan_to_num(recall[b]))
+            result[Metric.BASELINE_F1.value] = float(np.nan_to_num(f1[b]))
+        return result
@@ -1,8 +1,12 @@
-from segmentation_models_pytorch import encoders
-import segmentation_models_pytorch as smp
 from enum import Enum
 
-ENCODERS = smp.encoders.get_encoder_names()
+
+def __getattr__(name):
+    # segmentation_models_pytorch is slow to import, so it is only loaded once a model or the encoder list is needed
+    if name == 'ENCODERS':
+        import segmentation_models_pytorch as smp
+        return smp.encoders.get_encoder_names()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 class Architecture(Enum):
@@ -12,6 +16,7 @@ class Architecture(Enum):
     LINKNET = 'linknet'
 
     def get_architecture(self):
+        import segmentation_models_pytorch as smp
         return {'fpn': smp.FPN,
                 'unet': smp.Unet,
                 'pspnet': smp.PSPNet,
@@ -19,10 +24,12 @@ class Architecture(Enum):
 
     @staticmethod
     def get_all_architectures():
+        import segmentation_models_pytorch as smp
         return [smp.FPN, smp.Unet, smp.PSPNet, smp.Linknet]
 
     def get_architecture_params(self):
         import inspect
+        import segmentation_models_pytorch as smp
         t = {'fpn': smp.FPN,
              'unet': smp.Unet,
              'pspnet': smp.PSPNet,
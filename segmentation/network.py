@@ -1,19 +1,33 @@
 from segmentation.dataset import dirs_to_pandaframe, load_image_map_from_file, MaskDataset, compose, post_transforms
-from albumentations import (HorizontalFlip, ShiftScaleRotate, Normalize, Resize, Compose, GaussNoise)
+import contextlib
+import functools
 import gc
+from collections import OrderedDict
 from collections.abc import Iterable
 import torch
 import torch.nn as nn
-from torch.utils import data
 import logging
-from segmentation.settings import TrainSettings, PredictorSettings
-import segmentation_models_pytorch as sm
+from segmentation.settings import TrainSettings, PredictorSettings, OutputMode
+from segmentation.tiling import predict_tiled
+from segmentation.metrics import RunningMetrics, ConfusionMatrix, Metric
+from segmentation.sampler import data_loader, IGNORE_INDEX
+from segmentation.export import ExportFormat, load_exported
+from segmentation.checkpoint import AsyncCheckpointWriter, checkpoint_metadata, color_map_from_metadata, \
+    load_checkpoint, read_metadata
 from segmentation.dataset import label_to_colors, XMLDataset
-from typing import Union
+from typing import List, Union
 import numpy as np
-from pagexml_mask_converter.pagexml_to_mask import MaskGenerator, MaskSetting, BaseMaskGenerator, MaskType, PCGTSVersion
 
-from matplotlib import pyplot as plt
+_PAGEXML_NAMES = ('MaskGenerator', 'MaskSetting', 'BaseMaskGenerator', 'MaskType', 'PCGTSVersion')
+
+
+def __getattr__(name):
+    # mask generation classes used to be importable from here, pagexml_mask_converter is only loaded on access
+    if name in _PAGEXML_NAMES:
+        from pagexml_mask_converter import pagexml_to_mask
+        return getattr(pagexml_to_mask, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
 
 logger = logging.getLogger(__name__)
 logFormatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
@@ -74,39 +88,122 @@ def unpad(tensor, o_shape):
     return output
 
 
-def test(model, device, test_loader, criterion):
+def autocast(device, enabled=True):
+    '''
+    Mixed precision context: float16 autocast on cuda, bfloat16 autocast on cpu.
+    Falls back to full precision if the installed torch version does not support it.
+    '''
+    if enabled:
+        if device.type == 'cuda' and hasattr(torch.cuda, 'amp'):
+            return torch.cuda.amp.autocast()
+        if device.type == 'cpu' and hasattr(torch, 'cpu') and hasattr(torch.cpu, 'amp'):
+            return torch.cpu.amp.autocast(dtype=torch.bfloat16)
+        logger.warning('Mixed precision is not supported on {} by this torch version\n'.format(device.type))
+    return contextlib.nullcontext()
+
+
+def optimizer_step(optimizer, scaler=None):
+    optimizers = optimizer if isinstance(optimizer, Iterable) else [optimizer]
+    for opt in optimizers:
+        if scaler is not None:
+            # unscales the gradients of the param groups (shared with the base optimizer for Lookahead)
+            # and skips the step if they contain infs or nans
+            scaler.step(opt)
+        else:
+            opt.step()
+    if scaler is not None:
+        scaler.update()
+
+
+def forward_tta(model, data, transforms, pad_factor=32):
+    # Augmented variants with the same padded shape (e.g. identity and flips of one scale)
+    # are concatenated along the batch axis and run through the model in a single forward pass
+    o_shape = list(data.shape)[2:]
+    groups = OrderedDict()
+    for transformer in transforms:
+        augmented_image = transformer.augment_image(data)
+        shape = list(augmented_image.shape)[2:]
+        padded = pad(augmented_image, pad_factor)
+        groups.setdefault(tuple(padded.shape[2:]), []).append((transformer, shape, padded))
+
+    output_sum = None
+    n_outputs = 0
+    for members in groups.values():
+        input = torch.cat([padded for _, _, padded in members]).float()
+        output = model(input).float()
+        for (transformer, shape, _), chunk in zip(members, torch.split(output, data.shape[0])):
+            reversed = transformer.deaugment_mask(unpad(chunk, shape))
+            reversed = torch.nn.functional.interpolate(reversed, size=o_shape, mode="nearest")
+            output_sum = reversed if output_sum is None else output_sum + reversed
+            n_outputs += 1
+    return output_sum / n_outputs
+
+
+def output_to_numpy(output, mode: OutputMode = OutputMode.PROBABILITY, channels=None):
+    '''
+    Converts the (N, C, H, W) model output to a (H, W, C) array (N > 1: (N, H, W, C)) in the given output mode.
+    The label map of the argmax mode is (H, W) (N > 1: (N, H, W)), every other mode keeps the channel axis,
+    even with a single channel. The reduction runs on the device, so only the reduced array is copied to the host.
+    '''
+    output = output.detach()
+    if mode is OutputMode.ARGMAX:
+        out = output.argmax(dim=1).to(torch.uint8).cpu().numpy()
+    else:
+        if mode is OutputMode.QUANTIZED:
+            output = (torch.softmax(output.float(), dim=1) * 255).round_().to(torch.uint8)
+        elif mode is OutputMode.CHANNELS:
+            if not channels:
+                raise ValueError('OutputMode.CHANNELS needs a non-empty list of output channels')
+            output = output[:, list(channels)]
+        out = output.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+    # only the batch axis is dropped
+    return out[0] if out.shape[0] == 1 else out
+
+
+def validate(model, device, test_loader, criterion, n_classes, mixed_precision=False, channels_last=False):
+    '''
+    Returns the pixel accuracy, mean loss, per-class IoU/F1, their means and the baseline precision/recall
+    of the model on the test_loader (see ConfusionMatrix.compute)
+    '''
     model.eval()
-    test_loss = 0
-    correct = 0
-    total = 0
+    confusion = ConfusionMatrix(n_classes, device)
     with torch.no_grad():
         for idx, (data, target, id) in enumerate(test_loader):
-            data, target = data.to(device), target.to(device, dtype=torch.int64)
+            data = data.to(device, non_blocking=True)
+            target = target.to(device, dtype=torch.int64, non_blocking=True)
             shape = list(data.shape)[2:]
             padded = pad(data, 32)
 
             input = padded.float()
+            if channels_last:
+                input = input.contiguous(memory_format=torch.channels_last)
 
-            output = model(input)
-            output = unpad(output, shape)
-            test_loss += criterion(output, target)
-            _, predicted = torch.max(output.data, 1)
-
-            total += target.nelement()
-            correct += predicted.eq(target.data).sum().item()
+            with autocast(device, mixed_precision):
+                output = model(input)
+            output = unpad(output.float(), shape)
+            confusion.update(output.argmax(dim=1), target, loss=criterion(output, target))
             logger.info('\r Image [{}/{}'.format(idx * len(data), len(test_loader.dataset)))
 
-    test_loss /= len(test_loader.dataset)
-
+    metrics = confusion.compute()
     logger.info('\nTest set: Average loss: {:.4f}, Length of Test Set: {} ({:.6f}%)\n'.format(
-        test_loss, len(test_loader.dataset),
-        100. * correct / total))
+        metrics['loss'], len(test_loader.dataset), metrics['accuracy']))
+    logger.info('mIoU: {:.4f}, mean F1: {:.4f}, IoU: {}, F1: {}\n'.format(
+        metrics['mean_iou'], metrics['mean_f1'],
+        ' '.join('{:.4f}'.format(x) for x in metrics['iou']), ' '.join('{:.4f}'.format(x) for x in metrics['f1'])))
+    if 'baseline_precision' in metrics:
+        logger.info('Baseline precision: {:.4f}, recall: {:.4f}, F1: {:.4f}\n'.format(
+            metrics['baseline_precision'], metrics['baseline_recall'], metrics['baseline_f1']))
+    return metrics
+
 
-    return 100. * correct / total
+def test(model, device, test_loader, criterion, n_classes, mixed_precision=False, channels_last=False):
+    return validate(model, device, test_loader, criterion, n_classes, mixed_precision=mixed_precision,
+                    channels_last=channels_last)[Metric.ACCURACY.value]
 
 
 def train(model, device, train_loader, optimizer, epoch, criterion, accumulation_steps=8, color_map=None,
-          callback: TrainProgressCallbackWrapper = None, debug=False):
+          callback: TrainProgressCallbackWrapper = None, debug=False, mixed_precision=False, scaler=None,
+          channels_last=False, log_interval=10, augmentation=None):
     def debug_img(mask, target, original, color_map):
         if color_map is not None:
             from matplotlib import pyplot as plt
@@ -129,50 +226,50 @@ def train(model, device, train_loader, optimizer, epoch, criterion, accumulation
             plt.show()
 
     model.train()
-    total_train = 0
-    correct_train = 0
+    metrics = RunningMetrics(device)
 
     for batch_idx, (data, target, id) in enumerate(train_loader):
 
         data, target = data.to(device), target.to(device, dtype=torch.int64)
+        if augmentation is not None:
+            data, target = augmentation(data, target)
 
         shape = list(data.shape)[2:]
         padded = pad(data, 32)
 
         input = padded.float()
+        if channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
 
-        output = model(input)
-        output = unpad(output, shape)
-        loss = criterion(output, target)
-        loss = loss / accumulation_steps
-        loss.backward()
-        _, predicted = torch.max(output.data, 1)
-        total_train += target.nelement()
-        correct_train += predicted.eq(target.data).sum().item()
-        train_accuracy = 100 * correct_train / total_train
-        logger.info(
-            '\r Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}\tAccuracy: {:.6f}'.format(epoch, batch_idx * len(data),
-                                                                                          len(train_loader.dataset),
-                                                                                          100. * batch_idx / len(
-                                                                                              train_loader),
-                                                                                          loss.item(),
-                                                                                          train_accuracy)),
+        with autocast(device, mixed_precision):
+            output = model(input)
+            output = unpad(output, shape)
+            loss = criterion(output, target)
+            loss = loss / accumulation_steps
+        if scaler is not None:
+            scaler.scale(loss).backward()
+        else:
+            loss.backward()
+        metrics.update(loss, output.detach().argmax(dim=1), target)
         if (batch_idx + 1) % accumulation_steps == 0:  # Wait for several backward steps
             # debug_img(output, target, data, color_map)
-            if isinstance(optimizer, Iterable):  # Now we can do an optimizer step
-                for opt in optimizer:
-                    opt.step()
-            else:
-                optimizer.step()
+            optimizer_step(optimizer, scaler)  # Now we can do an optimizer step
             model.zero_grad()  # Reset gradients tensors
-        if callback:
-            callback.on_batch_end(batch_idx, loss=loss.item(), acc=train_accuracy)
-        gc.collect()
+        # metrics are only read (and the device synced) every log_interval batches
+        if (batch_idx + 1) % log_interval == 0 or batch_idx + 1 == len(train_loader):
+            train_loss, train_accuracy = metrics.loss(), metrics.accuracy()
+            logger.info(
+                '\r Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}\tAccuracy: {:.6f}'.format(
+                    epoch, batch_idx * len(data), len(train_loader.dataset), 100. * batch_idx / len(train_loader),
+                    train_loss, train_accuracy)),
+            if callback:
+                callback.on_batch_end(batch_idx, loss=train_loss, acc=train_accuracy)
 
 
 def train_unlabeled(model, device, train_loader, unlabeled_loader,
                     optimizer, epoch, criterion, accumulation_steps=8,
-                    color_map=None, train_step=50, alpha_factor=3, epoch_conv=15, debug=False):
+                    color_map=None, train_step=50, alpha_factor=3, epoch_conv=15, debug=False, mixed_precision=False,
+                    scaler=None, channels_last=False, log_interval=10, augmentation=None):
     def alpha_weight(epoch):
         return min((epoch / epoch_conv) * alpha_factor, alpha_factor)
 
@@ -198,56 +295,90 @@ def train_unlabeled(model, device, train_loader, unlabeled_loader,
             plt.show()
 
     model.train()
-    total_train = 0
-    correct_train = 0
+    metrics = RunningMetrics(device)
     for batch_idx, (data, target, id) in enumerate(unlabeled_loader):
         data = data.to(device)
         shape = list(data.shape)[2:]
         padded = pad(data, 32)
 
         input = padded.float()
+        if channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
         model.eval()
-        with torch.no_grad():
+        with torch.no_grad(), autocast(device, mixed_precision):
             output_unlabeled = model(input)
             output_unlabeled = unpad(output_unlabeled, shape)
             pseudo_labeled = torch.argmax(output_unlabeled, dim=1)
 
         model.train()
-        output = model(input)
-        output = unpad(output, shape)
-        if debug:
-            debug(output, pseudo_labeled, data, color_map)
-        loss = criterion(output, pseudo_labeled)
-        loss = (loss * alpha_weight(epoch)) / accumulation_steps
-        loss.backward()
-        _, predicted = torch.max(output.data, 1)
-        total_train += target.nelement()
-        correct_train += predicted.eq(pseudo_labeled.data).sum().item()
-        train_accuracy = 100 * correct_train / total_train
-        logger.info(
-            '\r Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}\tAccuracy: {:.6f}'.format(epoch, batch_idx * len(data),
-                                                                                          len(unlabeled_loader.dataset),
-                                                                                          100. * batch_idx / len(
-                                                                                              unlabeled_loader),
-                                                                                          loss.item(),
-                                                                                          train_accuracy)),
+        with autocast(device, mixed_precision):
+            output = model(input)
+            output = unpad(output, shape)
+            if debug:
+                debug(output, pseudo_labeled, data, color_map)
+            loss = criterion(output, pseudo_labeled)
+            loss = (loss * alpha_weight(epoch)) / accumulation_steps
+        if scaler is not None:
+            scaler.scale(loss).backward()
+        else:
+            loss.backward()
+        metrics.update(loss, output.detach().argmax(dim=1), pseudo_labeled)
         if (batch_idx + 1) % accumulation_steps == 0:  # Wait for several backward steps
             # debug(output, target, data, color_map)
-            if isinstance(optimizer, Iterable):  # Now we can do an optimizer stepd
-                for opt in optimizer:
-                    opt.step()
-            else:
-                optimizer.step()
+            optimizer_step(optimizer, scaler)  # Now we can do an optimizer step
             model.zero_grad()  # Reset gradients tensors
-        gc.collect()
+        if (batch_idx + 1) % log_interval == 0 or batch_idx + 1 == len(unlabeled_loader):
+            logger.info(
+                '\r Train Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}\tAccuracy: {:.6f}'.format(
+                    epoch, batch_idx * len(data), len(unlabeled_loader.dataset),
+                    100. * batch_idx / len(unlabeled_loader), metrics.loss(), metrics.accuracy())),
 
         if batch_idx + 1 % train_step == 0:  # used as correction with real data
             print('\n')
             train(model=model, device=device, optimizer=optimizer, train_loader=train_loader,
-                  epoch=epoch, criterion=criterion, accumulation_steps=accumulation_steps, color_map=color_map)
+                  epoch=epoch, criterion=criterion, accumulation_steps=accumulation_steps, color_map=color_map,
+                  mixed_precision=mixed_precision, scaler=scaler, channels_last=channels_last,
+                  log_interval=log_interval, augmentation=augmentation)
     pass
 
 
+def get_preprocessing_fn(encoder):
+    import segmentation_models_pytorch as sm
+    return sm.encoders.get_preprocessing_fn(encoder)
+
+
+def preprocessing_params(encoder):
+    import segmentation_models_pytorch as sm
+    return sm.encoders.get_preprocessing_params(encoder)
+
+
+def preprocess_input(x, input_space='RGB', input_range=None, mean=None, std=None, **kwargs):
+    '''
+    segmentation_models_pytorch.encoders._preprocessing.preprocess_input, without importing smp
+    '''
+    if input_space == 'BGR':
+        x = x[..., ::-1].copy()
+    if input_range is not None:
+        if x.max() > 1 and input_range[1] == 1:
+            x = x / 255.0
+    if mean is not None:
+        x = x - np.array(mean)
+    if std is not None:
+        x = x / np.array(std)
+    return x
+
+
+def preprocessing_from_metadata(metadata: dict):
+    '''
+    Input normalization stored in the checkpoint or export metadata. Falls back to smp for files
+    written without it.
+    '''
+    params = metadata.get('preprocessing')
+    if params is None:
+        return get_preprocessing_fn(metadata['encoder'])
+    return functools.partial(preprocess_input, **params)
+
+
 def get_model(architecture, kwargs):
     architecture = architecture.get_architecture()(**kwargs)
     return architecture
@@ -259,28 +390,38 @@ class Network(object):
         from segmentation.modules import Architecture
 
         self.settings = settings
+        self.exported = False
         architecture: Architecture = None
         encoder: str = None
         classes: int = None
         if isinstance(settings, PredictorSettings):
-            import os
-            with open(str(os.path.splitext(settings.MODEL_PATH)[0]) + '.meta', 'r') as f:
-                for x in f.readlines():
-                    x = x.strip('\n')
-                    if x.startswith('Encoder'):
-                        encoder = x.split(" ")[1]
-                    if x.startswith('Architecture'):
-                        architecture = Architecture(x.split(" ")[1])
-                    if x.startswith('Classes'):
-                        classes = int(x.split(" ")[1])
+            if settings.OUTPUT_MODE is OutputMode.CHANNELS and not settings.OUTPUT_CHANNELS:
+                raise ValueError('OutputMode.CHANNELS needs a non-empty OUTPUT_CHANNELS')
+            if settings.THREADS:
+                torch.set_num_threads(settings.THREADS)
+            if ExportFormat.from_path(settings.MODEL_PATH) is not None:
+                self._init_exported(color_map)
+                return
+            metadata = read_metadata(settings.MODEL_PATH)
+            encoder = metadata['encoder']
+            architecture = Architecture(metadata['architecture'])
+            classes = metadata['classes']
+            if color_map is None:
+                color_map = color_map_from_metadata(metadata)
+            self.preprocessing = preprocessing_from_metadata(metadata)
             if self.settings.PREDICT_DATASET is not None:
-                self.settings.PREDICT_DATASET.preprocessing = sm.encoders.get_preprocessing_fn(encoder)
+                self.settings.PREDICT_DATASET.preprocessing = self.preprocessing
         elif isinstance(settings, TrainSettings):
             encoder = self.settings.ENCODER
             architecture = self.settings.ARCHITECTURE
             classes = self.settings.CLASSES
-            self.settings.TRAIN_DATASET.preprocessing = sm.encoders.get_preprocessing_fn(self.settings.ENCODER)
-            self.settings.VAL_DATASET.preprocessing = sm.encoders.get_preprocessing_fn(self.settings.ENCODER)
+            self.preprocessing = get_preprocessing_fn(self.settings.ENCODER)
+            self.settings.TRAIN_DATASET.preprocessing = self.preprocessing
+            self.settings.VAL_DATASET.preprocessing = self.preprocessing
+            if self.settings.GPU_AUGMENTATION:
+                # workers only decode, augmentation and preprocessing run on collated batches in train
+                self.settings.TRAIN_DATASET.preprocessing = None
+                self.settings.TRAIN_DATASET.augmentation = None
         device = "cuda" if torch.cuda.is_available() else "cpu"
         print(device)
         self.device = torch.device(device)
@@ -290,15 +431,56 @@ class Network(object):
         self.model_params['encoder_name'] = encoder
         self.model = get_model(architecture, self.model_params)
         if self.settings.MODEL_PATH:
-            try:
-                self.model.load_state_dict(torch.load(self.settings.MODEL_PATH, map_location=torch.device(device)))
-            except Exception:
-                logger.warning('Could not load model weights, ... Skipping\n')
+            _, state_dict = load_checkpoint(self.settings.MODEL_PATH, map_location=torch.device(device))
+            self.model.load_state_dict(state_dict)
 
         self.color_map = color_map  # Optional for visualisation of mask data
         self.model.to(self.device)
+        if self.settings.CHANNELS_LAST:
+            self.model.to(memory_format=torch.channels_last)
         self.encoder = encoder
 
+    def _init_exported(self, color_map):
+        # exported graphs run on the cpu, the eager model is never built
+        metadata, self.model = load_exported(self.settings.MODEL_PATH, threads=self.settings.THREADS)
+        self.exported = True
+        self.device = torch.device('cpu')
+        self.model_params = None
+        self.encoder = metadata['encoder']
+        self.color_map = color_map if color_map is not None else color_map_from_metadata(metadata)
+        self.preprocessing = preprocessing_from_metadata(metadata)
+        if self.settings.PREDICT_DATASET is not None:
+            self.settings.PREDICT_DATASET.preprocessing = self.preprocessing
+
+    def quantize(self, dataset=None, n_pages: int = 16, min_f1: float = 0.95):
+        '''
+        Replaces the model by a static int8 quantized copy running on the cpu. The activations are calibrated
+        on n_pages pages of the dataset (defaults to PREDICT_DATASET), further pages are used to compare the
+        extracted baselines with those of the fp32 model. The model is only replaced if the F1 reaches min_f1.
+        '''
+        from segmentation.quantization import quantize_network, sample_pages
+        dataset = dataset if dataset is not None else self.settings.PREDICT_DATASET
+        pages = sample_pages(dataset, 2 * n_pages)
+        split = max(1, len(pages) // 2)
+        result = quantize_network(self.model, pages[:split], pages[split:] or pages, min_f1=min_f1)
+        if result.accepted:
+            self.model = result.model
+            self.device = torch.device('cpu')
+            # quantized models run like exported graphs: on the cpu, without autocast
+            self.exported = True
+        return result
+
+    def _output_to_numpy(self, output):
+        return output_to_numpy(output, self.settings.OUTPUT_MODE, self.settings.OUTPUT_CHANNELS)
+
+    def _run_model(self, input):
+        if self.exported:
+            return self.model(input)
+        if self.settings.CHANNELS_LAST:
+            input = input.contiguous(memory_format=torch.channels_last)
+        with autocast(self.device, self.settings.MIXED_PRECISION):
+            return self.model(input)
+
     def train(self, callback=None):
 
         if not isinstance(self.settings, TrainSettings):
@@ -306,11 +488,12 @@ class Network(object):
                 str(type(self.settings))))
             return
 
-        if callback:
-            callback = TrainProgressCallbackWrapper(len(self.settings.TRAIN_DATASET), callback)
-
-        criterion = nn.CrossEntropyLoss()
+        criterion = nn.CrossEntropyLoss(ignore_index=IGNORE_INDEX)
         self.model.float()
+        scaler = None
+        if self.settings.MIXED_PRECISION and self.device.type == 'cuda':
+            # float16 gradients need loss scaling, bfloat16 on cpu does not
+            scaler = torch.cuda.amp.GradScaler()
         opt = self.settings.OPTIMIZER.getOptimizer()
         try:
             optimizer1 = opt(self.model.encoder.parameters(), lr=self.settings.LEARNINGRATE_ENCODER)
@@ -320,46 +503,68 @@ class Network(object):
         except:
             optimizer = opt(self.model.parameters(), lr=self.settings.LEARNINGRATE_SEGHEAD)
 
-        train_loader = data.DataLoader(dataset=self.settings.TRAIN_DATASET, batch_size=self.settings.TRAIN_BATCH_SIZE,
-                                       shuffle=True, num_workers=self.settings.PROCESSES)
-        val_loader = data.DataLoader(dataset=self.settings.VAL_DATASET, batch_size=self.settings.VAL_BATCH_SIZE,
-                                     shuffle=False)
+        # batches of more than one page are bucketed by page size and padded
+        pin_memory = self.device.type == 'cuda'
+        train_loader = data_loader(self.settings.TRAIN_DATASET, batch_size=self.settings.TRAIN_BATCH_SIZE,
+                                   shuffle=True, num_workers=self.settings.PROCESSES, pin_memory=pin_memory)
+        val_loader = data_loader(self.settings.VAL_DATASET, batch_size=self.settings.VAL_BATCH_SIZE,
+                                 shuffle=False, num_workers=self.settings.PROCESSES, pin_memory=pin_memory)
         pseudo_loader = None
         if self.settings.PSEUDO_DATASET is not None:
-            pseudo_loader = data.DataLoader(dataset=self.settings.PSEUDO_DATASET,
-                                            batch_size=self.settings.TRAIN_BATCH_SIZE,
-                                            shuffle=True)
-        highest_accuracy = 0
+            pseudo_loader = data_loader(self.settings.PSEUDO_DATASET, batch_size=self.settings.TRAIN_BATCH_SIZE,
+                                        shuffle=True)
+        if callback:
+            # progress is counted in batches
+            callback = TrainProgressCallbackWrapper(len(train_loader), callback)
+        augmentation = None
+        if self.settings.GPU_AUGMENTATION:
+            from segmentation.gpu_augmentation import base_line_augmentation
+            augmentation = base_line_augmentation(preprocessing_params(self.settings.ENCODER))
+        checkpoint_writer = AsyncCheckpointWriter()
+        metadata = checkpoint_metadata(self.settings.ARCHITECTURE, self.settings.ENCODER, self.settings.CLASSES,
+                                       color_map=self.color_map)
+        selection_metric = self.settings.MODEL_SELECTION_METRIC
+        best_score = None
         logger.info(str(self.model) + "\n")
         logger.info(str(self.model_params) + "\n")
         logger.info('Training started ...\n"')
-        for epoch in range(1, self.settings.EPOCHS):
-            if self.settings.PSEUDO_DATASET is not None:
-                train_unlabeled(self.model, device=self.device, train_loader=train_loader,
-                                unlabeled_loader=pseudo_loader,
-                                optimizer=optimizer, epoch=epoch, criterion=criterion,
-                                accumulation_steps=self.settings.BATCH_ACCUMULATION,
-                                color_map=self.color_map, train_step=50, alpha_factor=3, epoch_conv=15)
-            else:
-                train(self.model, self.device, train_loader, optimizer, epoch, criterion,
-                      accumulation_steps=self.settings.BATCH_ACCUMULATION,
-                      color_map=self.color_map,
-                      callback=callback)
-            accuracy = test(self.model, self.device, val_loader, criterion=criterion)
-            if self.settings.OUTPUT_PATH is not None:
-
-                if accuracy > highest_accuracy:
-                    logger.info('Saving model to {}\n'.format(self.settings.OUTPUT_PATH + ".torch"))
-                    torch.save(self.model.state_dict(), self.settings.OUTPUT_PATH + ".torch")
-                    file = self.settings.OUTPUT_PATH + '.meta'
-                    with open(file, 'w') as filetowrite:
-                        filetowrite.write('Encoder: ' + str(self.settings.ENCODER) + '\n' +
-                                          'Architecture: ' + str(self.settings.ARCHITECTURE.value) + '\n' +
-                                          'Classes: ' + str(self.settings.CLASSES))
-
-                    highest_accuracy = accuracy
-                if callback:
-                    callback.on_epoch_end(epoch=epoch, acc=highest_accuracy)
+        # pending saves are finished and the writer thread is stopped even if training fails
+        try:
+            for epoch in range(1, self.settings.EPOCHS):
+                if self.settings.PSEUDO_DATASET is not None:
+                    train_unlabeled(self.model, device=self.device, train_loader=train_loader,
+                                    unlabeled_loader=pseudo_loader,
+                                    optimizer=optimizer, epoch=epoch, criterion=criterion,
+                                    accumulation_steps=self.settings.BATCH_ACCUMULATION,
+                                    color_map=self.color_map, train_step=50, alpha_factor=3, epoch_conv=15,
+                                    mixed_precision=self.settings.MIXED_PRECISION, scaler=scaler,
+                                    channels_last=self.settings.CHANNELS_LAST,
+                                    log_interval=self.settings.LOG_INTERVAL, augmentation=augmentation)
+                else:
+                    train(self.model, self.device, train_loader, optimizer, epoch, criterion,
+                          accumulation_steps=self.settings.BATCH_ACCUMULATION,
+                          color_map=self.color_map,
+                          callback=callback,
+                          mixed_precision=self.settings.MIXED_PRECISION, scaler=scaler,
+                          channels_last=self.settings.CHANNELS_LAST,
+                          log_interval=self.settings.LOG_INTERVAL, augmentation=augmentation)
+                gc.collect()
+                metrics = validate(self.model, self.device, val_loader, criterion=criterion,
+                                   n_classes=self.settings.CLASSES,
+                                   mixed_precision=self.settings.MIXED_PRECISION,
+                                   channels_last=self.settings.CHANNELS_LAST)
+                score = metrics[selection_metric.value]
+                if self.settings.OUTPUT_PATH is not None:
+
+                    if selection_metric.better(score, best_score):
+                        logger.info('Saving model to {}\n'.format(self.settings.OUTPUT_PATH + ".torch"))
+                        checkpoint_writer.save(self.settings.OUTPUT_PATH + ".torch", self.model.state_dict(), metadata)
+
+                        best_score = score
+                    if callback:
+                        callback.on_epoch_end(epoch=epoch, acc=best_score)
+        finally:
+            checkpoint_writer.close()
 
     def predict(self, tta_aug=None, debug=None):
         transforms = tta_aug
@@ -383,28 +588,13 @@ class Network(object):
         predict_loader = data.DataLoader(dataset=self.settings.PREDICT_DATASET,
                                          batch_size=1,
                                          shuffle=False, num_workers=self.settings.PROCESSES)
+        if self.settings.TILE_SIZE:
+            yield from self._predict_tiled(predict_loader, transforms)
+            return
         with torch.no_grad():
             for idx, (data, target, id) in enumerate(predict_loader):
                 data, target = data.to(self.device), target.to(self.device, dtype=torch.int64)
-                outputs = []
-                o_shape = data.shape
-                for transformer in transforms:
-                    augmented_image = transformer.augment_image(data)
-                    shape = list(augmented_image.shape)[2:]
-                    padded = pad(augmented_image, 32)  ## 2**5
-
-                    input = padded.float()
-                    output = self.model(input)
-                    output = unpad(output, shape)
-                    reversed = transformer.deaugment_mask(output)
-                    reversed = torch.nn.functional.interpolate(reversed, size=list(o_shape)[2:], mode="nearest")
-                    print("original: {} input: {}, padded: {} unpadded {} output {}".format(str(o_shape),
-                                                                                            str(shape), str(
-                            list(augmented_image.shape)), str(list(output.shape)), str(list(reversed.shape))))
-                    outputs.append(reversed)
-                stacked = torch.stack(outputs)
-                output = torch.mean(stacked, dim=0)
-                outputs.append(output)
+                output = forward_tta(self._run_model, data, transforms)
                 '''
                 def debug(mask, target, original, color_map):
                     if color_map is not None:
@@ -468,9 +658,7 @@ class Network(object):
                 if debug:
                     debug(output, target, data, self.color_map)
                 '''
-                out = output.data.cpu().numpy()
-                out = np.transpose(out, (0, 2, 3, 1))
-                out = np.squeeze(out)
+                out = self._output_to_numpy(output)
                 '''
                 def plot(outputs):
                     list_out = []
@@ -486,13 +674,35 @@ class Network(object):
                 '''
                 yield out
 
+    def _predict_tiled(self, predict_loader, transforms):
+        def pages():
+            for idx, (data, target, id) in enumerate(predict_loader):
+                yield idx, data.to(self.device)
+
+        with torch.no_grad():
+            for idx, output in predict_tiled(lambda batch: forward_tta(self._run_model, batch, transforms), pages(),
+                                             tile_size=self.settings.TILE_SIZE,
+                                             overlap=self.settings.TILE_OVERLAP,
+                                             batch_pixels=self.settings.TILE_BATCH_PIXELS,
+                                             passes=len(list(transforms))):
+                yield self._output_to_numpy(output)
+
     def predict_single_image(self, image: np.array, rgb=True, preprocessing=True, tta_aug=None):
-        from segmentation.dataset import process
         if not isinstance(self.settings, PredictorSettings):
             logger.warning('Settings is of type: {}. Pass settings to network object of type Train to train'.format(
                 str(type(self.settings))))
             return
-        # from torch.utils import data
+        data = self.prepare_image(image, rgb=rgb, preprocessing=preprocessing)
+        return self.predict_prepared(data, tta_aug=tta_aug)
+
+    def prepare_image(self, image: np.array, rgb=True, preprocessing=True):
+        from segmentation.dataset import process
+        image, pseudo_mask = process(image=image, mask=image, rgb=rgb, preprocessing=self.preprocessing,
+                                     apply_preprocessing=preprocessing, augmentation=None, color_map=None,
+                                     binary_augmentation=False)
+        return image.unsqueeze(0)
+
+    def predict_prepared(self, data, tta_aug=None):
         transforms = tta_aug
         if tta_aug is None:
             import ttach as tta
@@ -502,46 +712,53 @@ class Network(object):
                 ]
             )
         self.model.eval()
-        preprocessing_fn = sm.encoders.get_preprocessing_fn(self.encoder)
-        image, pseudo_mask = process(image=image, mask=image, rgb=rgb, preprocessing=preprocessing_fn,
-                                     apply_preprocessing=preprocessing, augmentation=None, color_map=None,
-                                     binary_augmentation=False)
-        # data = image
-        data = image.unsqueeze(0)
 
         with torch.no_grad():
             data = data.to(self.device)
+            if self.settings.TILE_SIZE:
+                _, output = next(predict_tiled(lambda batch: forward_tta(self._run_model, batch, transforms),
+                                               [(0, data)], tile_size=self.settings.TILE_SIZE,
+                                               overlap=self.settings.TILE_OVERLAP,
+                                               batch_pixels=self.settings.TILE_BATCH_PIXELS,
+                                               passes=len(list(transforms))))
+            else:
+                output = forward_tta(self._run_model, data, transforms)
+
+            return self._output_to_numpy(output)
 
-            outputs = []
-            o_shape = data.shape
-            for transformer in transforms:
-                augmented_image = transformer.augment_image(data)
-                shape = list(augmented_image.shape)[2:]
-                padded = pad(augmented_image, 32)  ## 2**5
-
-                input = padded.float()
-                output = self.model(input)
-                output = unpad(output, shape)
-                reversed = transformer.deaugment_mask(output)
-                reversed = torch.nn.functional.interpolate(reversed, size=list(o_shape)[2:], mode="nearest")
-                print("original: {} input: {}, padded: {} unpadded {} output {}".format(str(o_shape),
-                                                                                        str(shape), str(
-                        list(augmented_image.shape)), str(list(output.shape)), str(list(reversed.shape))))
-                outputs.append(reversed)
-            stacked = torch.stack(outputs)
-            output = torch.mean(stacked, dim=0)
-            out = output.data.cpu().numpy()
-            out = np.transpose(out, (0, 2, 3, 1))
-            out = np.squeeze(out)
-
-            return out
+    def _run_padded(self, batch):
+        # pads like forward_tta, so a page gives the same output alone, in a batch or as a tile
+        return unpad(self._run_model(pad(batch, 32).float()).float(), list(batch.shape)[2:])
+
+    def predict_batch(self, pages: List[torch.Tensor]) -> List[np.ndarray]:
+        '''
+        Predicts several prepared (1, C, H, W) pages of possibly different sizes. Pages whose size padded to
+        a multiple of 32 is the same run in a single forward pass (tiles of all pages, if tiling is enabled).
+        '''
+        self.model.eval()
+        with torch.no_grad():
+            if self.settings.TILE_SIZE:
+                pages = [(i, page.to(self.device)) for i, page in enumerate(pages)]
+                return [self._output_to_numpy(output) for _, output in
+                        predict_tiled(self._run_padded, pages,
+                                      tile_size=self.settings.TILE_SIZE, overlap=self.settings.TILE_OVERLAP,
+                                      batch_pixels=self.settings.TILE_BATCH_PIXELS)]
+            groups = OrderedDict()
+            for i, page in enumerate(pages):
+                groups.setdefault(tuple(pad(page, 32).shape[2:]), []).append(i)
+            outputs = [None] * len(pages)
+            for members in groups.values():
+                batch = torch.cat([pad(pages[i], 32) for i in members]).to(self.device).float()
+                output = self._run_model(batch).float()
+                for i, chunk in zip(members, torch.split(output, 1)):
+                    outputs[i] = self._output_to_numpy(unpad(chunk, list(pages[i].shape)[2:]))
+            return outputs
 
     def predict_single_image_by_path(self, path, rgb=True, preprocessing=True, tta_aug=None):
         from PIL import Image
-        from segmentation.dataset import get_rescale_factor, rescale_pil
-        image = Image.open(path)
-        rescale_factor = get_rescale_factor(image)
-        image = np.array(rescale_pil(image, rescale_factor, 1))
+        from segmentation.dataset import decode_rescaled
+        image, rescale_factor = decode_rescaled(Image.open(path))
+        image = np.array(image)
         return self.predict_single_image(image, rgb=rgb, preprocessing=preprocessing, tta_aug=tta_aug), rescale_factor
 
 
@@ -579,6 +796,7 @@ def plot_list(lsit):
         titles: List of titles corresponding to each image. Must have
                 the same length as titles.
         """
+        from matplotlib import pyplot as plt
         assert ((titles is None) or (len(images) == len(titles)))
         n_images = len(images)
         if titles is None: titles = ['Image (%d)' % i for i in range(1, n_images + 1)]
@@ -594,6 +812,7 @@ def plot_list(lsit):
 
 
 if __name__ == '__main__':
+    from pagexml_mask_converter.pagexml_to_mask import MaskGenerator, MaskSetting, MaskType, PCGTSVersion
     '''
     c = dirs_to_pandaframe(['/home/alexanderh/Downloads/New Folder/READ-ICDAR2019-cBAD-dataset-blind/train/'],
                            ['/home/alexanderh/Downloads/New Folder/READ-ICDAR2019-cBAD-dataset-blind/page/'])
@@ -0,0 +1,194 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Iterable, List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class PageTask(object):
+    '''
+    State of a single page while it moves through the pipeline
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.image_size: Tuple[int, int] = None  # (width, height) of the original image
+        self.rescale_factor: float = None
+        self.data = None  # preprocessed input tensor
+        self.output: np.ndarray = None  # probability or label map (argmax output mode) of the rescaled image
+        self.baselines: List[List[Tuple[int, int]]] = None  # in original image coordinates
+        self.xml_path: str = None
+        self.error: Exception = None
+
+
+def extract_page_baselines(probability_map: np.ndarray, rescale_factor: float = 1.0):
+    from segmentation.postprocessing.baseline_extraction import extraxct_baselines_from_probability_map
+    baselines = extraxct_baselines_from_probability_map(probability_map)
+    if baselines is None:
+        return []
+    return [[(int(x / rescale_factor), int(y / rescale_factor)) for x, y in baseline] for baseline in baselines]
+
+
+def _guarded(fn):
+    def run(task: PageTask):
+        if task.error is None:
+            try:
+                fn(task)
+            except Exception as e:
+                logger.warning('Failed to process {}: {}\n'.format(task.path, e))
+                task.error = e
+        return task
+
+    return run
+
+
+class PredictionPipeline(object):
+    '''
+    Streams pages through four stages, each running on its own worker pool:
+    decode and rescale -> model forward -> argmax and baseline extraction -> PAGE-XML serialization.
+    Stages are connected by bounded queues, so a slow stage throttles the ones in front of it
+    instead of buffering the whole batch in memory.
+    '''
+
+    def __init__(self, network, output_dir: str = None, decode_workers: int = 2, inference_workers: int = 1,
+                 postprocess_workers: int = 4, write_workers: int = 1, queue_size: int = 8, tta_aug=None,
+                 rgb: bool = True, preprocessing: bool = True):
+        self.network = network
+        self.output_dir = output_dir
+        self.decode_workers = decode_workers
+        self.inference_workers = inference_workers
+        self.postprocess_workers = postprocess_workers
+        self.write_workers = write_workers
+        self.queue_size = queue_size
+        self.tta_aug = tta_aug
+        self.rgb = rgb
+        self.preprocessing = preprocessing
+        self._process_pool = None
+        self._written = set()
+        self._written_lock = threading.Lock()
+
+    def decode(self, task: PageTask):
+        from PIL import Image
+        from segmentation.dataset import decode_rescaled
+        image = Image.open(task.path)
+        task.image_size = image.size
+        image, task.rescale_factor = decode_rescaled(image)
+        image = np.array(image)
+        task.data = self.network.prepare_image(image, rgb=self.rgb, preprocessing=self.preprocessing)
+
+    def infer(self, task: PageTask):
+        task.output = self.network.predict_prepared(task.data, tta_aug=self.tta_aug)
+        task.data = None
+
+    def postprocess(self, task: PageTask):
+        if self._process_pool is not None:
+            task.baselines = self._process_pool.submit(extract_page_baselines, task.output,
+                                                       task.rescale_factor).result()
+        else:
+            task.baselines = extract_page_baselines(task.output, task.rescale_factor)
+        task.output = None
+
+    def write(self, task: PageTask):
+        if self.output_dir is None:
+            return
+        from segmentation.gui.xml_util import XMLGenerator
+        name = os.path.splitext(os.path.basename(task.path))[0]
+        with self._written_lock:
+            # never overwrite the PAGE-XML of another page of this run
+            if name in self._written:
+                raise FileExistsError('{}.xml was already written for another image'.format(name))
+            self._written.add(name)
+        xml_gen = XMLGenerator(task.image_size[0], task.image_size[1], name, task.baselines)
+        xml_gen.save_textregions_as_xml(self.output_dir)
+        task.xml_path = os.path.join(self.output_dir, name + ".xml")
+
+    def run(self, paths: Iterable[str]):
+        '''
+        Processes the given image paths and yields the finished PageTasks in input order.
+        Pages that failed in any stage are yielded with the error attribute set.
+        '''
+        if self.output_dir is not None:
+            os.makedirs(self.output_dir, exist_ok=True)
+        self._written = set()
+        stop = threading.Event()
+        stages = [(_guarded(self.decode), ThreadPoolExecutor(max(1, self.decode_workers))),
+                  (_guarded(self.infer), ThreadPoolExecutor(max(1, self.inference_workers))),
+                  (_guarded(self.postprocess), ThreadPoolExecutor(max(1, self.postprocess_workers))),
+                  (_guarded(self.write), ThreadPoolExecutor(max(1, self.write_workers)))]
+        if self.postprocess_workers > 0:
+            # spawn, so the workers do not inherit the model or the threads of the other stages
+            self._process_pool = ProcessPoolExecutor(self.postprocess_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in stages]
+
+        def submit(executor, fn, task):
+            # executors are shut down when the consumer quits, a stage may still try to submit
+            try:
+                return executor.submit(fn, task)
+            except RuntimeError:
+                if stop.is_set():
+                    return None
+                raise
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def feed():
+            fn, executor = stages[0]
+            for path in paths:
+                if stop.is_set():
+                    return
+                future = submit(executor, fn, PageTask(path))
+                if future is None:
+                    return
+                put(queues[0], future)
+            put(queues[0], _END)
+
+        def forward(source, sink, fn, executor):
+            while not stop.is_set():
+                # a timeout, so the thread notices stop if the consumer quits while this stage waits for input
+                try:
+                    future = source.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if future is _END:
+                    put(sink, _END)
+                    return
+                future = submit(executor, fn, future.result())
+                if future is None:
+                    return
+                put(sink, future)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for i in range(1, len(stages)):
+            fn, executor = stages[i]
+            threads.append(threading.Thread(target=forward, args=(queues[i - 1], queues[i], fn, executor),
+                                            daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                future = queues[-1].get()
+                if future is _END:
+                    break
+                yield future.result()
+        finally:
+            stop.set()
+            for _, executor in stages:
+                executor.shutdown(wait=False)
+            if self._process_pool is not None:
+                self._process_pool.shutdown(wait=False)
+                self._process_pool = None
@@ -1,167 +1,169 @@
 import numpy as np
+from itertools import chain
+from typing import NamedTuple
 
 
 def extraxct_baselines_from_probability_map(image_map: np.array, base_line_index=1, base_line_border_index=2,
                                             original=None):
-    image = np.argmax(image_map, axis=-1)
+    # (H, W) label maps (argmax output mode) are used as they are
+    image = image_map if image_map.ndim == 2 else np.argmax(image_map, axis=-1)
     return extract_baselines(image_map=image, base_line_index=base_line_index,
                              base_line_border_index=base_line_border_index, original=original)
 
 
+def cluster_connected_components(left: np.ndarray, right: np.ndarray, is_baseline: np.ndarray,
+                                 baseline_border: np.ndarray, max_distance=100, angle=10):
+    '''
+    Clusters connected components (line fragments) into lines.
+
+    Two components are linked if the left endpoint of one lies to the right of the right
+    endpoint of the other, both are of the same type, the horizontal gap is at most max_distance,
+    the connecting segment deviates at most angle degrees from the horizontal (more for short gaps)
+    and does not cross a baseline border pixel. Candidate pairs are looked up in a KD-tree of the
+    left endpoints, so only nearby components are compared.
+    :param left: (n, 2) array of the (y, x) left endpoints
+    :param right: (n, 2) array of the (y, x) right endpoints
+    :param is_baseline: (n,) bool array, False for baseline border components
+    :return: cluster label of each component, numbered in order of first appearance
+    '''
+    from scipy.spatial import cKDTree
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    n = len(left)
+    # a link with horizontal gap d may deviate at most d * tan(5 * angle) vertically
+    radius = max_distance / np.cos(np.deg2rad(min(angle * 5, 89)))
+    candidates = cKDTree(left).query_ball_point(right, r=radius)
+    src = np.repeat(np.arange(n), [len(x) for x in candidates])
+    dst = np.fromiter(chain.from_iterable(candidates), dtype=np.int64, count=len(src))
+
+    keep = is_baseline[src] == is_baseline[dst]
+    src, dst = src[keep], dst[keep]
+    d_y = left[dst, 0] - right[src, 0]
+    d_x = left[dst, 1] - right[src, 1]
+    keep = (d_x > 0) & (d_x <= max_distance)
+    src, dst, d_y, d_x = src[keep], dst[keep], d_y[keep], d_x[keep]
+
+    test_angle = np.where(d_x > 30, angle, np.where(d_x > 5, angle * 3, angle * 5))
+    link_angle = np.rad2deg((-np.arctan2(d_y, d_x)) % (2 * np.pi))
+    keep = ~((test_angle < link_angle) & (link_angle < (360 - test_angle)))
+    src, dst, d_x = src[keep], dst[keep], d_x[keep]
+
+    links = []
+    for a, b, distance in zip(src, dst, d_x):
+        point_c = right[a]
+        point_n = left[b]
+        x_points = np.arange(start=point_c[1], stop=point_n[1] + 1)
+        y_points = np.interp(x_points, [point_c[1], point_n[1]], [point_c[0], point_n[0]]).astype(int)
+        blackness = np.sum(baseline_border[(y_points, x_points.astype(int))])
+        if distance * (blackness * 5000 + 1) <= max_distance:
+            links.append((a, b))
+
+    links = np.array(links, dtype=np.int64).reshape(-1, 2)
+    graph = coo_matrix((np.ones(len(links)), (links[:, 0], links[:, 1])), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    return labels
+
+
+class ConnectedComponents(NamedTuple):
+    ys: np.ndarray  # pixel coordinates of all components, grouped by component
+    xs: np.ndarray
+    offsets: np.ndarray  # pixels of component i are ys[offsets[i]:offsets[i + 1]]
+    left: np.ndarray  # (n, 2) (y, x) of the topmost pixel in the leftmost column
+    right: np.ndarray  # (n, 2) (y, x) of the topmost pixel in the rightmost column
+    mean_height: np.ndarray  # (n,) mean y of all pixels
+    size: np.ndarray  # (n,) number of pixels
+
+    def pixels(self, i):
+        return self.ys[self.offsets[i]:self.offsets[i + 1]], self.xs[self.offsets[i]:self.offsets[i + 1]]
+
+
+def connected_component_features(label_image: np.ndarray, n_labels: int) -> ConnectedComponents:
+    '''
+    Extracts the features of all components of a label image (as returned by scipy.ndimage.label)
+    in one pass over the foreground pixels, instead of one full image scan per label.
+    Within a component the pixels keep the row-major order of np.where(label_image == label).
+    '''
+    flat = label_image.ravel()
+    index = np.flatnonzero(flat)
+    labels = flat[index]
+    order = np.argsort(labels, kind='stable')
+    index, labels = index[order], labels[order] - 1
+    ys, xs = np.divmod(index, label_image.shape[1])
+
+    size = np.bincount(labels, minlength=n_labels)
+    offsets = np.concatenate([[0], np.cumsum(size)])
+    if n_labels == 0:
+        empty = np.zeros((0, 2), dtype=np.int64)
+        return ConnectedComponents(ys, xs, offsets, empty, empty, np.zeros(0), size)
+    starts = offsets[:-1]
+    mean_height = np.bincount(labels, weights=ys, minlength=n_labels) / size
+
+    def endpoint(column):
+        # topmost pixel of the given column per component
+        in_column = xs == column[labels]
+        y = np.minimum.reduceat(np.where(in_column, ys, np.iinfo(ys.dtype).max), starts)
+        return np.stack([y, column], axis=1)
+
+    left = endpoint(np.minimum.reduceat(xs, starts))
+    right = endpoint(np.maximum.reduceat(xs, starts))
+    return ConnectedComponents(ys, xs, offsets, left, right, mean_height, size)
+
+
+def normalize_connected_components(ys: np.ndarray, xs: np.ndarray, line_ids: np.ndarray, n_lines: int):
+    '''
+    Normalizes the pixels of each line, so that the height of each line is one pixel:
+    every column of a line is replaced by its rounded mean y.
+    :param ys: y coordinates of the pixels of all lines
+    :param xs: x coordinates of the pixels of all lines
+    :param line_ids: line index of every pixel
+    :return: list of n_lines (k, 2) int arrays of (x, y) points, sorted by x
+    '''
+    if len(xs) == 0:
+        return [np.zeros((0, 2), dtype=np.int64) for _ in range(n_lines)]
+    width = int(xs.max()) + 1
+    columns, inverse, counts = np.unique(line_ids.astype(np.int64) * width + xs, return_inverse=True,
+                                         return_counts=True)
+    mean_y = np.bincount(inverse.ravel(), weights=ys, minlength=len(columns)) / counts
+    points = np.stack([columns % width, np.floor(mean_y + 0.5).astype(np.int64)], axis=1)
+    offsets = np.searchsorted(columns // width, np.arange(n_lines + 1))
+    return [points[offsets[i]:offsets[i + 1]] for i in range(n_lines)]
+
+
 def extract_baselines(image_map: np.array, base_line_index=1, base_line_border_index=2, original=None):
     # from skimage import measure
     from scipy.ndimage.measurements import label
 
-    base_ind = np.where(image_map == base_line_index)
-    base_border_ind = np.where(image_map == base_line_border_index)
-
-    baseline = np.zeros(image_map.shape)
-    baseline_border = np.zeros(image_map.shape)
-    baseline[base_ind] = 1
-    baseline_border[base_border_ind] = 1
-    baseline_ccs, n_baseline_ccs = label(baseline, structure=[[1, 1, 1], [1, 1, 1], [1, 1, 1]])
-
-    baseline_ccs = [np.where(baseline_ccs == x) for x in range(1, n_baseline_ccs + 1)]
-    baseline_border_ccs, n_baseline_border_ccs = label(baseline_border, structure=[[1, 1, 1], [1, 1, 1], [1, 1, 1]])
-    baseline_border_ccs = [np.where(baseline_border_ccs == x) for x in range(1, n_baseline_border_ccs + 1)]
-
-    class Cc_with_type(object):
-        def __init__(self, cc, type):
-            self.cc = cc
-            index_min = np.where(cc[1] == min(cc[1]))  # [0]
-            index_max = np.where(cc[1] == max(cc[1]))  # [0]
-
-            if type == 'baseline':
-                self.cc_left = (np.mean(cc[0][index_min][0]), cc[1][index_min[0]][0])
-                self.cc_right = (np.mean(cc[0][index_max][0]), cc[1][index_max[0]][0])
-
-            else:
-                self.cc_left = (np.mean(cc[0]), cc[1][index_min[0]][0])
-                self.cc_right = (np.mean(cc[0]), cc[1][index_max[0]][0])
-
-            self.type = type
-
-        def __lt__(self, other):
-            return self.cc < other
-
-    baseline_ccs = [Cc_with_type(x, 'baseline') for x in baseline_ccs if len(x[0]) > 10]
-
-    baseline_border_ccs = [Cc_with_type(x, 'baseline_border') for x in baseline_border_ccs if len(x[0]) > 10]
-
-    all_ccs = baseline_ccs + baseline_border_ccs
-    from segmentation.util import pairwise, angle_between, angle_to
-
-    def calculate_distance_matrix(ccs, length=50):
-        distance_matrix = np.zeros((len(ccs), len(ccs)))
-        vertical_distance = 10
-        for ind1, x in enumerate(ccs):
-            for ind2, y in enumerate(ccs):
-                if x is y:
-                    distance_matrix[ind1, ind2] = 0
-                else:
-                    distance = 0
-                    same_type = 1 if x.type == y.type else 1000
-
-                    def left(x, y):
-                        return x.cc_left[1] > y.cc_right[1]
-
-                    def right(x, y):
-                        return x.cc_right[1] < y.cc_left[1]
-
-                    ANGLE = 10
-                    if left(x, y):
-                        angle = angle_to(np.array(y.cc_right), np.array(x.cc_left))
-                        distance = x.cc_left[1] - y.cc_right[1]
-                        test_angle = ANGLE if distance > 30 else ANGLE * 3 if distance > 5 else ANGLE * 5
-                        if test_angle < angle < (360 - test_angle):
-                            distance = 99999
-                        else:
-                            point_c = y.cc_right
-                            point_n = x.cc_left
-
-                            x_points = np.arange(start=point_c[1], stop=point_n[1] + 1)
-                            y_points = np.interp(x_points, [point_c[1], point_n[1]], [point_c[0], point_n[0]]).astype(
-                                int)
-                            indexes = (y_points, x_points)
-
-                            blackness = np.sum(baseline_border[indexes])
-                            # print('left' + str(blackness))
-                            distance = distance * (blackness * 5000 + 1)
-
-                    elif right(x, y):
-                        angle = angle_to(np.array(x.cc_right), np.array(y.cc_left))
-                        distance = y.cc_left[1] - x.cc_right[1]
-                        test_angle = ANGLE if distance > 30 else ANGLE * 3 if distance > 5 else ANGLE * 5
-
-                        if test_angle < angle < (360 - test_angle):
-                            distance = 99999
-                        else:
-                            distance = y.cc_left[1] - x.cc_right[1]
-
-                            point_c = x.cc_right
-                            point_n = y.cc_left
-
-                            x_points = np.arange(start=point_c[1], stop=point_n[1] + 1)
-                            y_points = np.interp(x_points, [point_c[1], point_n[1]],
-                                                 [point_c[0], point_n[0]]).astype(
-                                int)
-                            indexes = (y_points, x_points)
-
-                            blackness = np.sum(baseline_border[indexes])
-                            distance = distance * (blackness * 5000 + 1)
-                    else:
-                        distance = 99999
-
-                    distance_matrix[ind1, ind2] = distance * same_type
-        return distance_matrix
-
-    matrix = calculate_distance_matrix(all_ccs)
-
-    from sklearn.cluster import DBSCAN
-    if np.sum(matrix) == 0:
+    structure = [[1, 1, 1], [1, 1, 1], [1, 1, 1]]
+    baseline = image_map == base_line_index
+    baseline_border = image_map == base_line_border_index
+    baseline_ccs = connected_component_features(*label(baseline, structure=structure))
+    baseline_border_ccs = connected_component_features(*label(baseline_border, structure=structure))
+
+    baseline_ind = np.flatnonzero(baseline_ccs.size > 10)
+    border_ind = np.flatnonzero(baseline_border_ccs.size > 10)
+    n_baselines = len(baseline_ind)
+    if n_baselines + len(border_ind) <= 1:
         print("Empty Image")
         return
-    t = DBSCAN(eps=100, min_samples=1, metric="precomputed").fit(matrix)
-    debug_image = np.zeros(image_map.shape)
-    for ind, x in enumerate(all_ccs):
-        debug_image[x.cc] = t.labels_[ind]
-
-    ccs = []
-    for x in np.unique(t.labels_):
-        ind = np.where(t.labels_ == x)
-        line = []
-        for d in ind[0]:
-            if all_ccs[d].type == 'baseline':
-                line.append(all_ccs[d])
-        if len(line) > 0:
-            ccs.append((np.concatenate([x.cc[0] for x in line]), np.concatenate([x.cc[1] for x in line])))
-
-    ccs = [list(zip(x[0], x[1])) for x in ccs]
-
-    from itertools import chain
-    from typing import List, Tuple
-    from collections import defaultdict
-    def normalize_connected_components(cc_list: List[List[Tuple[int, int]]]):
-        # Normalize the CCs (line segments), so that the height of each cc is normalized to one pixel
-        def normalize(point_list):
-            normalized_cc_list = []
-            for cc in point_list:
-                cc_dict = defaultdict(list)
-                for y, x in cc:
-                    cc_dict[x].append(y)
-                normalized_cc = []
-                # for key, value in cc_dict.items():
-                for key in sorted(cc_dict.keys()):
-                    value = cc_dict[key]
-                    normalized_cc.append([int(np.floor(np.mean(value) + 0.5)), key])
-                normalized_cc_list.append(normalized_cc)
-            return normalized_cc_list
-
-        return normalize(cc_list)
-
-    ccs = normalize_connected_components(ccs)
-    new_ccs = []
-    for baseline in ccs:
-        new_ccs.append([coord_tup[::-1] for coord_tup in baseline])
-
-    return new_ccs
+
+    # borders are linked at their mean height
+    border_left = np.stack([baseline_border_ccs.mean_height[border_ind], baseline_border_ccs.left[border_ind, 1]], 1)
+    border_right = np.stack([baseline_border_ccs.mean_height[border_ind], baseline_border_ccs.right[border_ind, 1]],
+                            1)
+    labels = cluster_connected_components(
+        left=np.concatenate([baseline_ccs.left[baseline_ind], border_left]).astype(np.float64),
+        right=np.concatenate([baseline_ccs.right[baseline_ind], border_right]).astype(np.float64),
+        is_baseline=np.arange(n_baselines + len(border_ind)) < n_baselines,
+        baseline_border=baseline_border)
+
+    baseline_labels = labels[:n_baselines]
+    lines = [baseline_ind[baseline_labels == x] for x in np.unique(baseline_labels)]
+    if len(lines) == 0:
+        return []
+    pixels = [baseline_ccs.pixels(i) for i in np.concatenate(lines)]
+    ys = np.concatenate([y for y, _ in pixels])
+    xs = np.concatenate([x for _, x in pixels])
+    line_ids = np.repeat(np.arange(len(lines)), [baseline_ccs.size[line].sum() for line in lines])
+
+    return normalize_connected_components(ys, xs, line_ids, len(lines))
@@ -25,7 +25,9 @@ SOFTWARE.
 ================================
 '''
 
-from numpy import array, argmin
+import heapq
+from typing import List
+
 import numpy as np
 
 
@@ -84,6 +86,121 @@ def remove(s, i):
     s[i:-1] = s[i + 1:]
 
 
+def effective_areas(pts, offsets):
+    '''
+    Visvalingam-Whyatt effective areas of the vertices of several polylines, concatenated in pts (N, 2)
+    with line i spanning pts[offsets[i]:offsets[i + 1]]. Vertices are eliminated smallest area first using
+    a heap, O(n log n); the areas of the neighbours of an eliminated vertex are recomputed and clamped to be
+    at least the area of the eliminated vertex. End points of the lines have an infinite area.
+    '''
+    pts = np.asarray(pts, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n = len(pts)
+    areas = np.full(n, np.inf)
+    if n == 0:
+        return areas
+    index = np.arange(n)
+    first = np.zeros(n, dtype=bool)
+    last = np.zeros(n, dtype=bool)
+    first[offsets[:-1][np.diff(offsets) > 0]] = True
+    last[offsets[1:][np.diff(offsets) > 0] - 1] = True
+    inner = ~(first | last)
+    p1, p2, p3 = pts[index[inner] - 1], pts[inner], pts[index[inner] + 1]
+    areas[inner] = np.abs(p1[:, 0] * (p2[:, 1] - p3[:, 1]) + p2[:, 0] * (p3[:, 1] - p1[:, 1]) +
+                          p3[:, 0] * (p1[:, 1] - p2[:, 1])) / 2.
+
+    prev = (index - 1).tolist()
+    next = (index + 1).tolist()
+    first = first.tolist()
+    last = last.tolist()
+    xs = pts[:, 0].tolist()
+    ys = pts[:, 1].tolist()
+    values = areas.tolist()
+    removed = [False] * n
+
+    def area(i):
+        a, b = prev[i], next[i]
+        return abs(xs[a] * (ys[i] - ys[b]) + xs[i] * (ys[b] - ys[a]) + xs[b] * (ys[a] - ys[i])) / 2.
+
+    # (area, rank, index): a neighbour clamped to the area of the vertex just eliminated is eliminated next,
+    # the left one first, otherwise ties are broken by the position in the line
+    heap = [(values[i], 2, i) for i in index[inner].tolist()]
+    heapq.heapify(heap)
+    ranks = [2] * n
+    heappush, heappop = heapq.heappush, heapq.heappop
+    while heap:
+        value, rank, i = heappop(heap)
+        # skip eliminated vertices and entries superseded by a recomputed area
+        if removed[i] or values[i] != value or ranks[i] != rank:
+            continue
+        removed[i] = True
+        this_area = value
+        left, right = prev[i], next[i]
+        next[left] = right
+        prev[right] = left
+        for neighbour, clamped_rank in ((right, 1), (left, 0)):
+            if first[neighbour] or last[neighbour]:
+                continue
+            new_area = area(neighbour)
+            new_rank = 2
+            if new_area <= this_area:
+                new_area = this_area
+                new_rank = clamped_rank
+            values[neighbour] = new_area
+            ranks[neighbour] = new_rank
+            heappush(heap, (new_area, new_rank, neighbour))
+    return np.array(values)
+
+
+class VWBatchSimplifier(object):
+    '''
+    Simplifies all polylines of a page at once. The lines are given as one concatenated (N, 2) coordinate
+    array and offsets (line i is pts[offsets[i]:offsets[i + 1]]), or as a list of lines with from_lines.
+    '''
+
+    def __init__(self, pts, offsets):
+        self.pts = np.asarray(pts, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.line_ids = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        self.thresholds = effective_areas(self.pts, self.offsets)
+
+    @staticmethod
+    def from_lines(lines):
+        lengths = [len(line) for line in lines]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        pts = np.concatenate([np.asarray(line, dtype=np.float64).reshape(-1, 2) for line in lines]) \
+            if len(lines) > 0 else np.zeros((0, 2))
+        return VWBatchSimplifier(pts, offsets)
+
+    def _split(self, keep) -> List[np.ndarray]:
+        kept_offsets = np.concatenate([[0], np.cumsum(np.bincount(self.line_ids[keep],
+                                                                  minlength=len(self.offsets) - 1))])
+        pts = self.pts[keep]
+        return [pts[kept_offsets[i]:kept_offsets[i + 1]] for i in range(len(self.offsets) - 1)]
+
+    def from_threshold(self, threshold) -> List[np.ndarray]:
+        '''
+        Keeps the vertices with an effective area of at least threshold
+        '''
+        return self._split(self.thresholds >= threshold)
+
+    def from_number(self, n) -> List[np.ndarray]:
+        '''
+        Same as VWSimplifier.from_number for every line: keeps the vertices whose area is above
+        the n-th largest area of their line, lines with at most n vertices are kept unchanged
+        '''
+        n = int(n)
+        lengths = np.diff(self.offsets)
+        # descending areas within each line
+        order = np.lexsort((-self.thresholds, self.line_ids))
+        line_threshold = np.full(len(lengths), -np.inf)
+        long_lines = np.flatnonzero(lengths > n)
+        line_threshold[long_lines] = self.thresholds[order[self.offsets[long_lines] + n]]
+        keep = self.thresholds > line_threshold[self.line_ids]
+        keep |= (lengths <= n)[self.line_ids]
+        return self._split(keep)
+
+
 class VWSimplifier(object):
 
     def __init__(self, pts):
@@ -99,83 +216,7 @@ class VWSimplifier(object):
         use to mask an array of points for any threshold value.
         returns a numpy.array (length of pts)  of the areas.
         '''
-        pts = self.pts
-        nmax = len(pts)
-        real_areas = triangle_areas_from_array(pts)
-        real_indices = list(range(nmax))
-
-        # destructable copies
-        # ARG! areas=real_areas[:] doesn't make a copy!
-        areas = np.copy(real_areas)
-        i = real_indices[:]
-        # pick first point and set up for loop
-        min_vert = argmin(areas)
-        this_area = areas[min_vert]
-        #  areas and i are modified for each point finished
-        remove(areas, min_vert)  # faster
-        # areas = np.delete(areas,min_vert) #slower
-        real_idx = i.pop(min_vert)
-
-        # cntr = 3
-        while this_area < np.inf:
-            '''min_vert was removed from areas and i.  Now,
-            adjust the adjacent areas and remove the new 
-            min_vert.
-            Now that min_vert was filtered out, min_vert points 
-            to the point after the deleted point.'''
-
-            skip = False  # modified area may be the next minvert
-
-            try:
-                right_area = triangle_area(pts[i[min_vert - 1]],
-                                           pts[i[min_vert]], pts[i[min_vert + 1]])
-            except IndexError:
-                # trying to update area of endpoint. Don't do it
-                pass
-            else:
-                right_idx = i[min_vert]
-                if right_area <= this_area:
-                    # even if the point now has a smaller area,
-                    # it ultimately is not more significant than
-                    # the last point, which needs to be removed
-                    # first to justify removing this point.
-                    # Though this point is the next most significant
-                    right_area = this_area
-
-                    # min_vert refers to the point to the right of
-                    # the previous min_vert, so we can leave it
-                    # unchanged if it is still the min_vert
-                    skip = min_vert
-
-                # update both collections of areas
-                real_areas[right_idx] = right_area
-                areas[min_vert] = right_area
-
-            if min_vert > 1:
-                # cant try/except because 0-1=-1 is a valid index
-                left_area = triangle_area(pts[i[min_vert - 2]],
-                                          pts[i[min_vert - 1]], pts[i[min_vert]])
-                if left_area <= this_area:
-                    # same justification as above
-                    left_area = this_area
-                    skip = min_vert - 1
-                real_areas[i[min_vert - 1]] = left_area
-                areas[min_vert - 1] = left_area
-
-            # only argmin if we have too.
-            min_vert = skip or argmin(areas)
-            real_idx = i.pop(min_vert)
-            this_area = areas[min_vert]
-            # areas = np.delete(areas,min_vert) #slower
-            remove(areas, min_vert)  # faster
-            '''if sum(np.where(areas==np.inf)[0]) != sum(list(reversed(range(len(areas))))[:cntr]):
-              print "broke:",np.where(areas==np.inf)[0],cntr
-              break
-            cntr+=1
-            #if real_areas[0]<np.inf or real_areas[-1]<np.inf:
-            #  print "NO!", real_areas[0], real_areas[-1]
-            '''
-        return real_areas
+        return effective_areas(self.pts, np.array([0, len(self.pts)]))
 
     def from_threshold(self, threshold):
         return self.pts[self.thresholds >= threshold]
@@ -0,0 +1,161 @@
+import copy
+import inspect
+import logging
+from typing import NamedTuple, List
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class QuantizationResult(NamedTuple):
+    model: torch.nn.Module
+    # mean baseline F1 of the quantized model measured against the fp32 model
+    baseline_f1: float
+    accepted: bool
+
+
+def sample_pages(dataset, n_pages: int = 16, seed: int = 0) -> List[torch.Tensor]:
+    '''
+    Preprocessed (1, C, H, W) inputs of n_pages random pages of a PredictDataset
+    '''
+    rng = np.random.RandomState(seed)
+    items = rng.choice(len(dataset), size=min(n_pages, len(dataset)), replace=False)
+    return [dataset[int(i)][0].unsqueeze(0).float() for i in items]
+
+
+class QuantizationUnsupported(RuntimeError):
+    pass
+
+
+class QuantizedSegmentationModel(torch.nn.Module):
+    '''
+    encoder, decoder and segmentation head of a segmentation_models_pytorch model, quantized separately.
+    Every part quantizes its input and returns float tensors.
+    '''
+
+    def __init__(self, encoder, decoder, segmentation_head, unpack_features: bool):
+        super().__init__()
+        self.encoder = encoder
+        self.decoder = decoder
+        self.segmentation_head = segmentation_head
+        self.unpack_features = unpack_features
+
+    def forward(self, x):
+        features = self.encoder(x)
+        output = self.decoder(*features) if self.unpack_features else self.decoder(features)
+        return self.segmentation_head(output)
+
+
+def _unpack_features(decoder) -> bool:
+    # smp decoders take the encoder features as *features up to 0.4, as a list since
+    parameters = inspect.signature(decoder.forward).parameters.values()
+    return any(p.kind is inspect.Parameter.VAR_POSITIONAL for p in parameters)
+
+
+def _prepare(name: str, module, qconfig_mapping, example_inputs):
+    from torch.ao.quantization.quantize_fx import prepare_fx
+    try:
+        return prepare_fx(module, qconfig_mapping, example_inputs=example_inputs)
+    except Exception as e:
+        raise QuantizationUnsupported('Quantization unsupported for this model: the {} ({}) cannot be traced: {}'
+                                      .format(name, type(module).__name__, e)) from e
+
+
+def quantize_model(model, calibration_pages: List[torch.Tensor], backend: str = 'fbgemm'):
+    '''
+    Static int8 post-training quantization (FX graph mode) of a copy of the model.
+    Activation ranges are calibrated on the given pages.
+    SegmentationModel.forward branches on the input shape, so encoder, decoder and segmentation head are traced
+    separately. Raises QuantizationUnsupported if one of them cannot be traced.
+    '''
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx
+    from segmentation.export import prepare_for_export
+    from segmentation.network import pad
+
+    if not all(hasattr(model, x) for x in ('encoder', 'decoder', 'segmentation_head')):
+        raise QuantizationUnsupported('Quantization unsupported for this model: {} is not a '
+                                      'segmentation_models_pytorch model'.format(type(model).__name__))
+    if getattr(model, 'classification_head', None) is not None:
+        raise QuantizationUnsupported('Quantization unsupported for this model: classification heads are not '
+                                      'supported')
+
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    model = prepare_for_export(copy.deepcopy(model).cpu())
+    unpack_features = _unpack_features(model.decoder)
+    with torch.no_grad():
+        example = pad(calibration_pages[0], 32)
+        features = model.encoder(example)
+        decoder_inputs = tuple(features) if unpack_features else (features,)
+        output = model.decoder(*decoder_inputs)
+        encoder = _prepare('encoder', model.encoder, qconfig_mapping, (example,))
+        decoder = _prepare('decoder', model.decoder, qconfig_mapping, decoder_inputs)
+        segmentation_head = _prepare('segmentation head', model.segmentation_head, qconfig_mapping, (output,))
+        prepared = QuantizedSegmentationModel(encoder, decoder, segmentation_head, unpack_features)
+        for page in calibration_pages:
+            prepared(pad(page, 32))
+    return QuantizedSegmentationModel(convert_fx(encoder), convert_fx(decoder), convert_fx(segmentation_head),
+                                      unpack_features).eval()
+
+
+def _predict_baselines(model, page):
+    from segmentation.network import pad, unpad
+    from segmentation.postprocessing.baseline_extraction import extract_baselines
+    with torch.no_grad():
+        output = unpad(model(pad(page, 32)).float(), list(page.shape)[2:])
+    labels = output.argmax(dim=1)[0].numpy()
+    return extract_baselines(labels) or [], labels.shape
+
+
+def _rasterize(baselines, shape):
+    from PIL import Image, ImageDraw
+    image = Image.new('1', (shape[1], shape[0]))
+    draw = ImageDraw.Draw(image)
+    for baseline in baselines:
+        points = [tuple(int(v) for v in p) for p in baseline]
+        if len(points) > 1:
+            draw.line(points, fill=1, width=1)
+        elif len(points) == 1:
+            draw.point(points, fill=1)
+    return np.array(image, dtype=bool)
+
+
+def baseline_f1(reference, candidate, shape, tolerance: int = 3) -> float:
+    '''
+    F1 of the candidate baselines against the reference baselines, counting baseline pixels
+    within tolerance pixels of the other polylines as matched
+    '''
+    from scipy.ndimage import binary_dilation
+    reference = _rasterize(reference, shape)
+    candidate = _rasterize(candidate, shape)
+    if not reference.any() and not candidate.any():
+        return 1.0
+    structure = np.ones((2 * tolerance + 1, 2 * tolerance + 1), dtype=bool)
+    precision = (candidate & binary_dilation(reference, structure)).sum() / max(candidate.sum(), 1)
+    recall = (reference & binary_dilation(candidate, structure)).sum() / max(reference.sum(), 1)
+    if precision + recall == 0:
+        return 0.0
+    return float(2 * precision * recall / (precision + recall))
+
+
+def quantize_network(model, calibration_pages: List[torch.Tensor], evaluation_pages: List[torch.Tensor],
+                     min_f1: float = 0.95, backend: str = 'fbgemm') -> QuantizationResult:
+    '''
+    Quantizes the model and compares the baselines extracted from its predictions with those of the fp32 model.
+    The quantized model is only accepted if the mean baseline F1 reaches min_f1.
+    '''
+    reference_model = copy.deepcopy(model).cpu().eval()
+    quantized = quantize_model(model, calibration_pages, backend=backend)
+    scores = []
+    for page in evaluation_pages:
+        reference, shape = _predict_baselines(reference_model, page)
+        candidate, _ = _predict_baselines(quantized, page)
+        scores.append(baseline_f1(reference, candidate, shape))
+    score = float(np.mean(scores)) if len(scores) > 0 else 0.
+    accepted = score >= min_f1
+    logger.info('Quantized model baseline F1 against fp32: {:.4f} ({})\n'.format(
+        score, 'accepted' if accepted else 'rejected'))
+    return QuantizationResult(model=quantized, baseline_f1=score, accepted=accepted)
@@ -0,0 +1,83 @@
+import math
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from torch.utils import data
+
+# default ignore index of nn.CrossEntropyLoss, used for the padded target pixels
+IGNORE_INDEX = -100
+
+
+def page_sizes(dataset) -> List[Tuple[int, int]]:
+    return [tuple(dataset.page_size(i)) for i in range(len(dataset))]
+
+
+class BucketBatchSampler(data.Sampler):
+    '''
+    Groups pages of similar (padded height, padded width) into the same batch, so batches of
+    variable-sized pages need little padding. Pages are ordered by bucket (shuffled within a bucket),
+    cut into batches, and the order of the batches is shuffled.
+    '''
+
+    def __init__(self, sizes: List[Tuple[int, int]], batch_size: int, shuffle: bool = True,
+                 pad_factor: int = 32, drop_last: bool = False):
+        sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+        self.heights = -(-sizes[:, 0] // pad_factor)
+        self.widths = -(-sizes[:, 1] // pad_factor)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        n = len(self.heights)
+        order = torch.randperm(n).numpy() if self.shuffle else np.arange(n)
+        # lexsort is stable, so pages stay shuffled within a bucket
+        order = order[np.lexsort((self.widths[order], self.heights[order]))]
+        batches = [order[i:i + self.batch_size] for i in range(0, n, self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.heights) // self.batch_size
+        return math.ceil(len(self.heights) / self.batch_size)
+
+
+def pad_collate(batch, pad_factor: int = 32, ignore_index: int = IGNORE_INDEX):
+    '''
+    Pads images and masks of a batch to a common size divisible by pad_factor.
+    Padded pixels of label masks are set to ignore_index, so they neither contribute to the loss nor to metrics.
+    '''
+    images, masks, ids = zip(*batch)
+    height = math.ceil(max(x.shape[-2] for x in images) / pad_factor) * pad_factor
+    width = math.ceil(max(x.shape[-1] for x in images) / pad_factor) * pad_factor
+
+    image_batch = images[0].new_zeros((len(images), images[0].shape[0], height, width))
+    for i, image in enumerate(images):
+        image_batch[i, :, :image.shape[-2], :image.shape[-1]] = image
+
+    if masks[0].dim() == 2:
+        mask_batch = torch.full((len(masks), height, width), ignore_index, dtype=torch.int64)
+    else:
+        # images used as masks (unlabeled data), (H, W, C)
+        mask_batch = masks[0].new_zeros((len(masks), height, width) + tuple(masks[0].shape[2:]))
+    for i, mask in enumerate(masks):
+        mask_batch[i, :mask.shape[0], :mask.shape[1]] = mask
+
+    return image_batch, mask_batch, torch.stack(ids)
+
+
+def data_loader(dataset, batch_size: int = 1, shuffle: bool = False, **kwargs):
+    '''
+    DataLoader for variable-sized pages. Batches of more than one page are built by a BucketBatchSampler and
+    padded by pad_collate, single pages are passed through unchanged.
+    '''
+    if batch_size > 1 and hasattr(dataset, 'page_size'):
+        sampler = BucketBatchSampler(page_sizes(dataset), batch_size, shuffle=shuffle)
+        return data.DataLoader(dataset=dataset, batch_sampler=sampler, collate_fn=pad_collate, **kwargs)
+    return data.DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, **kwargs)
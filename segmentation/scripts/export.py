@@ -0,0 +1,76 @@
+import argparse
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, required=True,
+                        help="path to the trained model checkpoint")
+    parser.add_argument("-O", "--output", type=str, required=True,
+                        help="target file, the format is taken from the extension (.torchscript or .onnx)")
+    parser.add_argument("--color-map", dest="map", type=str, default=None,
+                        help="color map stored with the model, if the checkpoint does not contain one")
+    parser.add_argument("--example-size", type=int, nargs=2, default=[512, 512],
+                        help="height and width of the example input used for tracing")
+    parser.add_argument("--no-optimize", action="store_true",
+                        help="Do not freeze and fuse the TorchScript graph")
+    parser.add_argument("--quantize-input", type=str, nargs="*", default=[],
+                        help="Quantize the model to int8 (TorchScript only), calibrated on images of these folder(s)")
+    parser.add_argument("--quantize-pages", type=int, default=16,
+                        help="Number of pages used for calibration (and as many for the accuracy check)")
+    parser.add_argument("--min-f1", type=float, default=0.95,
+                        help="Minimum baseline F1 of the quantized model against the fp32 model")
+    args = parser.parse_args()
+
+    from segmentation.export import ExportFormat, export_torchscript, export_onnx
+    from segmentation.checkpoint import read_metadata, checkpoint_metadata
+    from segmentation.modules import Architecture
+    from segmentation.network import Network
+    from segmentation.settings import PredictorSettings
+
+    export_format = ExportFormat.from_path(args.output)
+    if export_format is None:
+        parser.error("output must end with .torchscript or .onnx")
+
+    color_map = None
+    if args.map is not None:
+        from segmentation.dataset import load_image_map_from_file
+        color_map = load_image_map_from_file(args.map)
+    dataset = None
+    if len(args.quantize_input) > 0:
+        if export_format is not ExportFormat.TORCHSCRIPT:
+            parser.error("quantized models can only be exported as TorchScript")
+        from segmentation.dataset import dirs_to_pandaframe, PredictDataset
+        dataset = PredictDataset(dirs_to_pandaframe(args.quantize_input, args.quantize_input), color_map=None,
+                                 mask_generator=None)
+    network = Network(PredictorSettings(MODEL_PATH=args.model, PREDICT_DATASET=dataset), color_map=color_map)
+    metadata = read_metadata(args.model)
+    metadata = checkpoint_metadata(Architecture(metadata['architecture']), metadata['encoder'], metadata['classes'],
+                                   color_map=network.color_map)
+
+    optimize = not args.no_optimize
+    if dataset is not None:
+        from segmentation.quantization import QuantizationUnsupported
+        try:
+            result = network.quantize(n_pages=args.quantize_pages, min_f1=args.min_f1)
+        except QuantizationUnsupported as e:
+            print(e)
+            return
+        if not result.accepted:
+            print("Quantized model rejected, baseline F1 {:.4f} < {}".format(result.baseline_f1, args.min_f1))
+            return
+        metadata['quantized'] = True
+        # the quantized graph is already fused, inference optimization targets fp32 mkldnn kernels
+        optimize = False
+
+    if export_format is ExportFormat.TORCHSCRIPT:
+        export_torchscript(network.model, args.output, metadata, example_size=args.example_size,
+                           optimize=optimize)
+    else:
+        export_onnx(network.model, args.output, metadata, example_size=args.example_size)
+    print("Exported model to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,45 +4,118 @@ import argparse
 import json
 import numpy as np
 import os
-import tqdm
-from PIL import Image
-import itertools
 import random
 
-def get_image_colors(path_to_mask: np.array):
+BLACK_AND_WHITE = [(255, 255, 255), (0, 0, 0)]
+CACHE_FILE = 'image_map_cache.json'
+# number of scanned masks between two writes of the cache
+CACHE_FLUSH_INTERVAL = 500
+# part of every cached signature, increment when color_keys changes
+CACHE_VERSION = 2
+
+# presence bitmap over all 24 bit colors, one per worker process
+_present = None
+
+
+def color_keys(path_to_mask: str, chunk_rows: int = 256) -> np.ndarray:
+    '''
+    Returns the sorted packed colors (r << 16 | g << 8 | b) of a mask. The decoded mask is converted in chunks
+    of rows, each chunk marks its colors in a presence bitmap, so no full-size array of packed keys is built.
+    PIL still decodes the whole image, so memory grows with the image size.
+    '''
+    global _present
+    from PIL import Image
     image_pil = Image.open(path_to_mask)
+    # the datasets read palette masks as 2D arrays of indices, like gray masks
     if image_pil.mode == 'RGBA':
         image_pil = image_pil.convert('RGB')
-    mask = np.asarray(image_pil)
-    if mask.ndim == 2 or mask.shape[2] == 2:
-        return [(255, 255, 255), (0, 0, 0)]
-    tt = mask.view()
-    tt.shape = -1, 3
-    height, width, depth = mask.shape
-    ifl = tt[..., 0].astype(np.int) * height * width + tt[..., 1].astype(np.int) * width + tt[..., 2].astype(np.int)
-    colors = np.unique(ifl, return_inverse=False)
-    colors = [(int(color / (height * width)), int((color / width) % height), int(color % width)) for color in colors]
-    return colors
-
-
-def compute_image_map(input_dir, output_dir, max_images=-1, processes=4):
+    if image_pil.mode != 'RGB':
+        return np.array([(r << 16) | (g << 8) | b for r, g, b in BLACK_AND_WHITE], dtype=np.int64)
+    if _present is None:
+        _present = np.zeros(1 << 24, dtype=bool)
+    width, height = image_pil.size
+    for y in range(0, height, chunk_rows):
+        chunk = np.asarray(image_pil.crop((0, y, width, min(y + chunk_rows, height))))
+        keys = (chunk[..., 0].astype(np.uint32) << 16) | (chunk[..., 1].astype(np.uint32) << 8) | chunk[..., 2]
+        _present[keys.ravel()] = True
+    keys = np.flatnonzero(_present)
+    _present[keys] = False
+    return keys
+
+
+def get_image_colors(path_to_mask: str):
+    return [(int(k) >> 16, (int(k) >> 8) & 255, int(k) & 255) for k in color_keys(path_to_mask)]
+
+
+def _scan(path):
+    return path, color_keys(path).tolist()
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size, CACHE_VERSION]
+
+
+def load_cache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def save_cache(cache_path, cache):
+    # written to a temporary file first, an interrupted write keeps the previous cache
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(cache, fp)
+    os.replace(tmp_path, cache_path)
+
+
+def compute_image_map(input_dir, output_dir, max_images=-1, processes=4, use_cache=True):
+    '''
+    Collects the colors of all masks in input_dir and writes them to output_dir/image_map.json.
+    The colors of every mask are cached together with its modification time and size,
+    so only new or changed masks are scanned when the map is computed again. The cache is written every
+    CACHE_FLUSH_INTERVAL masks, so an interrupted run keeps most of its work, and entries of masks which no longer
+    exist in input_dir are dropped.
+    '''
     if not os.path.exists(input_dir):
         raise Exception("Cannot open {}".format(input_dir))
-    files = [os.path.join(input_dir, f) for f in os.listdir(input_dir)]
+    with os.scandir(input_dir) as it:
+        files = sorted(entry.path for entry in it if entry.is_file())
 
+    existing = set(files)
     if max_images > 0:
         files = random.sample(files, max_images)
-
-    with multiprocessing.Pool(processes=processes) as p:
-        colors = [v for v in
-                        tqdm.tqdm(p.imap(get_image_colors, files), total=len(files))
-                        ]
-    colors = set(itertools.chain.from_iterable(colors))
-    colors = sorted(colors, key=lambda element: (element[0], element[1], element[2]))[::-1]
-    color_dict = {str(key): (value, "label") for (value, key) in enumerate(colors)}
     if output_dir:
         os.makedirs(output_dir, exist_ok=True)
 
+    cache_path = os.path.join(output_dir, CACHE_FILE) if use_cache else None
+    cache = load_cache(cache_path)
+    cache = {path: entry for path, entry in cache.items() if path in existing}
+    signatures = {path: _file_signature(path) for path in files}
+    pending = [path for path in files if path not in cache or cache[path]['signature'] != signatures[path]]
+
+    import tqdm
+    if len(pending) > 0:
+        with multiprocessing.Pool(processes=processes) as p:
+            for i, (path, keys) in enumerate(tqdm.tqdm(p.imap_unordered(_scan, pending, chunksize=4),
+                                                       total=len(pending))):
+                cache[path] = {'signature': signatures[path], 'colors': keys}
+                if cache_path is not None and (i + 1) % CACHE_FLUSH_INTERVAL == 0:
+                    save_cache(cache_path, cache)
+    if cache_path is not None:
+        save_cache(cache_path, cache)
+
+    keys = set()
+    for path in files:
+        keys.update(cache[path]['colors'])
+    colors = [(k >> 16, (k >> 8) & 255, k & 255) for k in sorted(keys, reverse=True)]
+    color_dict = {str(key): (value, "label") for (value, key) in enumerate(colors)}
+
     with open(os.path.join(output_dir, 'image_map.json'), 'w') as fp:
         json.dump(color_dict, fp)
 
@@ -67,8 +140,10 @@ def main():
                         help="Max images to check for color. -1 to check every mask")
     parser.add_argument("--processes", type=int, default=4,
                         help="Number of processes to run")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Rescan every mask instead of reusing the colors cached in the output dir")
     args = parser.parse_args()
-    compute_image_map(args.input_dir, args.output_dir, args.max_image, args.processes)
+    compute_image_map(args.input_dir, args.output_dir, args.max_image, args.processes, use_cache=not args.no_cache)
 
 
 if __name__ == '__main__':
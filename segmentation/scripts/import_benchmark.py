@@ -0,0 +1,64 @@
+import argparse
+import json
+import subprocess
+import sys
+
+# modules which must not be loaded by importing the inference entry points
+HEAVY_MODULES = ('matplotlib', 'pandas', 'albumentations', 'pagexml_mask_converter', 'skimage',
+                 'segmentation_models_pytorch', 'sklearn', 'cv2')
+
+DEFAULT_MODULES = ('segmentation.settings', 'segmentation.network', 'segmentation.pipeline',
+                   'segmentation.postprocessing.baseline_extraction', 'segmentation.scripts.predict',
+                   'segmentation.scripts.image_map')
+
+_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+print(json.dumps({{"seconds": duration, "heavy": sorted(m for m in {heavy!r} if m in sys.modules)}}))
+'''
+
+
+def measure(module: str, repeats: int = 3):
+    '''
+    Imports the module in fresh interpreters and returns the fastest import time and the heavy modules it loaded
+    '''
+    best = None
+    heavy = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        best = result['seconds'] if best is None else min(best, result['seconds'])
+        heavy = result['heavy']
+    return best, heavy
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures import times of the package entry points and fails "
+                                                 "if one of them pulls in a heavy optional dependency")
+    parser.add_argument("--modules", type=str, nargs="*", default=list(DEFAULT_MODULES),
+                        help="Modules to import")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="Number of fresh interpreters per module, the fastest run is reported")
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="Fail if an import takes longer")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        seconds, heavy = measure(module, args.repeats)
+        status = 'ok'
+        if len(heavy) > 0:
+            status = 'imports ' + ', '.join(heavy)
+            failed = True
+        elif args.max_seconds is not None and seconds > args.max_seconds:
+            status = 'slower than {:.2f}s'.format(args.max_seconds)
+            failed = True
+        print("{:<50} {:8.3f}s  {}".format(module, seconds, status))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
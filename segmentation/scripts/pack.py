@@ -0,0 +1,47 @@
+import argparse
+from os import path
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+
+def dir_path(string):
+    if path.isdir(string):
+        return string
+    else:
+        raise NotADirectoryError(string)
+
+
+def main():
+    from segmentation.dataset import load_image_map_from_file, XMLDataset, MaskDataset, pack_dataset
+    from segmentation.dataset_index import index_dirs
+    from pagexml_mask_converter.pagexml_to_mask import MaskGenerator, MaskSetting, MaskType, PCGTSVersion
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=dir_path, nargs="+", default=[], help="Path to folder(s) containing images")
+    parser.add_argument("--mask", type=dir_path, nargs="+", default=[],
+                        help="Path to folder(s) containing xmls or mask images")
+    parser.add_argument("--mask-images", action="store_true",
+                        help="Masks are color images instead of PAGE-XML files")
+    parser.add_argument("--color-map", dest="map", type=str, required=True,
+                        help="path to color map to load")
+    parser.add_argument("-O", "--output", type=str, required=True,
+                        help="target directory of the packed dataset")
+    parser.add_argument("--processes", type=int, default=4,
+                        help="Number of processes to run")
+    parser.add_argument("--index-threads", type=int, default=16,
+                        help="Number of threads reading image headers while indexing the input folders")
+    args = parser.parse_args()
+
+    df = index_dirs(args.input, args.mask, threads=args.index_threads)
+    map = load_image_map_from_file(args.map)
+    if args.mask_images:
+        dataset = MaskDataset(df, map)
+    else:
+        settings = MaskSetting(MASK_TYPE=MaskType.BASE_LINE, PCGTS_VERSION=PCGTSVersion.PCGTS2013, LINEWIDTH=5,
+                               BASELINELENGTH=10)
+        dataset = XMLDataset(df, map, mask_generator=MaskGenerator(settings=settings))
+    pack_dataset(dataset, args.output, processes=args.processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+from os import path
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp')
+
+
+def collect_images(inputs, lists, extensions=IMAGE_EXTENSIONS):
+    images = []
+    for p in inputs:
+        if path.isdir(p):
+            with os.scandir(p) as it:
+                images += sorted(entry.path for entry in it
+                                 if entry.is_file() and entry.name.lower().endswith(extensions))
+        elif path.isfile(p):
+            images.append(p)
+        else:
+            raise FileNotFoundError(p)
+    for list_file in lists:
+        with open(list_file) as f:
+            images += [line.strip() for line in f if len(line.strip()) > 0]
+    return images
+
+
+def name_collisions(images):
+    '''
+    Groups of images which would be written to the same PAGE-XML file (same file name without extension)
+    '''
+    by_name = {}
+    for image in images:
+        by_name.setdefault(path.splitext(path.basename(image))[0], []).append(image)
+    return [x for x in by_name.values() if len(x) > 1]
+
+
+class Manifest(object):
+    '''
+    Append-only record of processed pages (one json object per line).
+    Pages marked as done are skipped when a job is restarted, failed pages are retried.
+    '''
+
+    def __init__(self, manifest_path: str):
+        self.path = manifest_path
+        self.done = set()
+        if path.exists(manifest_path):
+            with open(manifest_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of a crashed run may be truncated
+                        continue
+                    if entry.get('status') == 'done':
+                        self.done.add(entry['image'])
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.file.close()
+
+    def pending(self, images):
+        return [x for x in images if x not in self.done]
+
+    def record(self, task):
+        entry = {'image': task.path, 'xml': task.xml_path,
+                 'status': 'done' if task.error is None else 'failed'}
+        if task.error is not None:
+            entry['error'] = str(task.error)
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, nargs="*", default=[],
+                        help="Image files or folder(s) containing images")
+    parser.add_argument("--input-list", type=str, nargs="*", default=[],
+                        help="Text file(s) with one image path per line")
+    parser.add_argument("--model", type=str, required=True,
+                        help="path to the trained model (checkpoint, .torchscript or .onnx export)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Number of cpu threads used for inference")
+    parser.add_argument("-O", "--output", type=str, required=True,
+                        help="target directory for the PAGE-XML files")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="manifest recording processed pages, defaults to <output>/manifest.jsonl")
+    parser.add_argument("--tta", action="store_true",
+                        help="Enable test time augmentation (3 scales x horizontal flip)")
+    parser.add_argument("--tile-size", type=int, default=None,
+                        help="Enable tiled inference with the given tile size")
+    parser.add_argument("--tile-overlap", type=int, default=64,
+                        help="Overlap of neighbouring tiles")
+    parser.add_argument("--decode-workers", type=int, default=2,
+                        help="Number of threads decoding and rescaling images")
+    parser.add_argument("--inference-workers", type=int, default=1,
+                        help="Number of threads running the model")
+    parser.add_argument("--postprocess-workers", type=int, default=4,
+                        help="Number of processes extracting baselines")
+    parser.add_argument("--write-workers", type=int, default=1,
+                        help="Number of threads writing PAGE-XML files")
+    parser.add_argument("--queue-size", type=int, default=8,
+                        help="Maximum number of pages buffered between two stages")
+    args = parser.parse_args()
+
+    from segmentation.network import Network
+    from segmentation.settings import PredictorSettings, OutputMode
+    from segmentation.pipeline import PredictionPipeline
+
+    images = collect_images(args.input, args.input_list)
+    collisions = name_collisions(images)
+    if len(collisions) > 0:
+        parser.error("images with the same name would overwrite each other's PAGE-XML: {}".format(
+            "; ".join(", ".join(x) for x in collisions)))
+    os.makedirs(args.output, exist_ok=True)
+    manifest_path = args.manifest or path.join(args.output, 'manifest.jsonl')
+
+    tta_aug = None
+    if args.tta:
+        import ttach as tta
+        tta_aug = tta.Compose([tta.Scale(scales=[0.95, 1, 1.05]), tta.HorizontalFlip()])
+
+    settings = PredictorSettings(MODEL_PATH=args.model, TILE_SIZE=args.tile_size, TILE_OVERLAP=args.tile_overlap,
+                                 THREADS=args.threads,
+                                 # only the label map is needed for baseline extraction
+                                 OUTPUT_MODE=OutputMode.ARGMAX)
+    network = Network(settings)
+    pipeline = PredictionPipeline(network, output_dir=args.output,
+                                  decode_workers=args.decode_workers,
+                                  inference_workers=args.inference_workers,
+                                  postprocess_workers=args.postprocess_workers,
+                                  write_workers=args.write_workers,
+                                  queue_size=args.queue_size,
+                                  tta_aug=tta_aug)
+    import tqdm
+
+    with Manifest(manifest_path) as manifest:
+        pending = manifest.pending(images)
+        print("{} of {} pages already processed".format(len(images) - len(pending), len(images)))
+        failed = 0
+        for task in tqdm.tqdm(pipeline.run(pending), total=len(pending)):
+            manifest.record(task)
+            if task.error is not None:
+                failed += 1
+    if failed > 0:
+        print("{} pages failed, see {}".format(failed, manifest_path))
+
+
+if __name__ == "__main__":
+    main()
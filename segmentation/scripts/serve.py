@@ -0,0 +1,57 @@
+import argparse
+import warnings
+warnings.simplefilter(action='ignore', category=FutureWarning)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, required=True,
+                        help="path to the trained model (checkpoint, .torchscript or .onnx export)")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="address to listen on")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="port to listen on")
+    parser.add_argument("--socket", type=str, default=None,
+                        help="listen on this unix socket instead of host and port")
+    parser.add_argument("--path-root", type=str, default=None,
+                        help="Allow clients to request images by path (?path=) below this directory")
+    parser.add_argument("--max-batch-size", type=int, default=8,
+                        help="Maximum number of pages predicted together")
+    parser.add_argument("--max-latency", type=float, default=10,
+                        help="Milliseconds a request waits for further requests to batch with")
+    parser.add_argument("--tile-size", type=int, default=None,
+                        help="Enable tiled inference with the given tile size")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Number of cpu threads used for inference")
+    parser.add_argument("--output-mode", type=str, default="probability",
+                        choices=["probability", "argmax", "quantized"],
+                        help="Format of returned probability maps")
+    args = parser.parse_args()
+
+    import os
+    from segmentation.network import Network
+    from segmentation.settings import PredictorSettings, OutputMode
+    from segmentation.server import BatchingPredictor, PredictionServer, UnixPredictionServer
+
+    network = Network(PredictorSettings(MODEL_PATH=args.model, TILE_SIZE=args.tile_size, THREADS=args.threads,
+                                        OUTPUT_MODE=OutputMode(args.output_mode)))
+    predictor = BatchingPredictor(network, max_batch_size=args.max_batch_size, max_latency=args.max_latency / 1000)
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixPredictionServer(args.socket, predictor, path_root=args.path_root)
+        print("Listening on unix://{}".format(args.socket))
+    else:
+        server = PredictionServer((args.host, args.port), predictor, path_root=args.path_root)
+        print("Listening on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        predictor.close()
+
+
+if __name__ == "__main__":
+    main()
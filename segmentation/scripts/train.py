@@ -14,7 +14,8 @@ def dir_path(string):
 
 
 def main():
-    from segmentation.network import TrainSettings, dirs_to_pandaframe, load_image_map_from_file, MaskSetting, MaskType, PCGTSVersion, XMLDataset, Network, compose, MaskGenerator, MaskDataset
+    from segmentation.network import TrainSettings, load_image_map_from_file, XMLDataset, Network, compose, MaskDataset
+    from pagexml_mask_converter.pagexml_to_mask import MaskGenerator, MaskSetting, MaskType, PCGTSVersion
     from segmentation.settings import Architecture
     from segmentation.modules import ENCODERS
 
@@ -29,12 +30,37 @@ def main():
                         help="number of epochs")
     parser.add_argument("--data-augmentation", action="store_true",
                         help="Enable data augmentation")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="Pages per batch, pages are grouped by size and padded")
+    parser.add_argument("--batch-accumulation", type=int, default=8,
+                        help="Number of batches accumulated before an optimizer step")
+    parser.add_argument("--mixed-precision", action="store_true",
+                        help="Train with float16 (cuda) or bfloat16 (cpu) autocast")
+    parser.add_argument("--channels-last", action="store_true",
+                        help="Use the channels last memory format for model and inputs")
+    parser.add_argument("--gpu-augmentation", action="store_true",
+                        help="Augment and normalize collated training batches on the device instead of in the workers")
     parser.add_argument("--train_input", type=dir_path, nargs="+", default=[], help="Path to folder(s) containing train images")
     parser.add_argument("--train_mask", type=dir_path, nargs="+", default=[], help="Path to folder(s) containing train xmls")
 
     parser.add_argument("--test_input", type=dir_path, nargs="*", default=[], help="Path to folder(s) containing test images")
     parser.add_argument("--test_mask", type=dir_path, nargs="+", default=[], help="Path to folder(s) containing test xmls")
 
+    parser.add_argument("--train-packed", type=dir_path, default=None,
+                        help="Path to a packed training set (see scripts/pack.py), replaces --train_input/--train_mask")
+    parser.add_argument("--test-packed", type=dir_path, default=None,
+                        help="Path to a packed test set (see scripts/pack.py), replaces --test_input/--test_mask")
+
+    parser.add_argument("--index-cache", type=str, default=None,
+                        help="Directory for the dataset index manifests, reused while the input folders are unchanged")
+    parser.add_argument("--index-threads", type=int, default=16,
+                        help="Number of threads reading image headers while indexing the input folders")
+
+    parser.add_argument("--mask-cache", type=str, default=None,
+                        help="Directory caching the masks rendered from the xml files across epochs and runs")
+    parser.add_argument("--mask-cache-memory", type=int, default=512,
+                        help="MB of encoded masks kept in memory (per DataLoader worker)")
+
     parser.add_argument("--color-map", dest="map", type=str, required=True,
                         help="path to color map to load")
     parser.add_argument('--architecture',
@@ -52,21 +78,49 @@ def main():
 
     args = parser.parse_args()
 
-    train = dirs_to_pandaframe(args.train_input, args.train_mask)
-    test = dirs_to_pandaframe(args.test_input, args.train_mask) if len(args.test_input) > 0 else train
     map = load_image_map_from_file(args.map)
-    from segmentation.dataset import base_line_transform
+    from segmentation.dataset import base_line_transform, PackedDataset
+    from segmentation.dataset_index import index_dirs, manifest_path
+
+    def index(images_dir, masks_dir):
+        manifest = manifest_path(args.index_cache, images_dir, masks_dir) if args.index_cache else None
+        return index_dirs(images_dir, masks_dir, manifest=manifest, threads=args.index_threads)
 
     settings = MaskSetting(MASK_TYPE=MaskType.BASE_LINE, PCGTS_VERSION=PCGTSVersion.PCGTS2013, LINEWIDTH=5,
                            BASELINELENGTH=10)
-    train_dataset = XMLDataset(train, map, transform=compose([base_line_transform()]),
-                    mask_generator=MaskGenerator(settings=settings))
-    test_dataset = XMLDataset(test, map, transform=compose([base_line_transform()]),
-                        mask_generator=MaskGenerator(settings=settings))
+
+    def mask_generator():
+        generator = MaskGenerator(settings=settings)
+        if args.mask_cache is None:
+            return generator
+        from segmentation.mask_cache import CachedMaskGenerator
+        return CachedMaskGenerator(generator, args.mask_cache, memory_bytes=args.mask_cache_memory * 1024 * 1024,
+                                   settings=settings)
+    if args.train_packed:
+        train_dataset = PackedDataset(args.train_packed, transform=compose([base_line_transform()]))
+    else:
+        train = index(args.train_input, args.train_mask)
+        train_dataset = XMLDataset(train, map, transform=compose([base_line_transform()]),
+                                   mask_generator=mask_generator())
+    if args.test_packed:
+        test_dataset = PackedDataset(args.test_packed, transform=compose([base_line_transform()]))
+    elif len(args.test_input) > 0 or not args.train_packed:
+        test = index(args.test_input, args.train_mask) if len(args.test_input) > 0 \
+            else index(args.train_input, args.train_mask)
+        test_dataset = XMLDataset(test, map, transform=compose([base_line_transform()]),
+                                  mask_generator=mask_generator())
+    else:
+        test_dataset = PackedDataset(args.train_packed, transform=compose([base_line_transform()]))
 
     setting = TrainSettings(CLASSES=len(map), TRAIN_DATASET=train_dataset, VAL_DATASET=test_dataset,
                             OUTPUT_PATH=args.output,
-                            MODEL_PATH=args.load)
+                            MODEL_PATH=args.load,
+                            TRAIN_BATCH_SIZE=args.batch_size,
+                            VAL_BATCH_SIZE=args.batch_size,
+                            BATCH_ACCUMULATION=args.batch_accumulation,
+                            MIXED_PRECISION=args.mixed_precision,
+                            CHANNELS_LAST=args.channels_last,
+                            GPU_AUGMENTATION=args.gpu_augmentation)
     trainer = Network(setting, color_map=map)
     trainer.train()
 
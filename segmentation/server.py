@@ -0,0 +1,291 @@
+import http.client
+import io
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from urllib.parse import urlparse, parse_qs, urlencode
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def _padded_pixels(page) -> int:
+    return -(-page.shape[2] // 32) * 32 * -(-page.shape[3] // 32) * 32
+
+
+class BatchingPredictor(object):
+    '''
+    Runs concurrent prediction requests on a single Network. Requests arriving within max_latency seconds
+    of the first waiting request are coalesced into one batch (up to max_batch_size pages and max_batch_pixels
+    input pixels), so throughput grows with the number of concurrent clients.
+    '''
+
+    def __init__(self, network, max_batch_size: int = 8, max_latency: float = 0.01,
+                 max_batch_pixels: int = 8 * 1024 * 1024, rgb: bool = True, preprocessing: bool = True):
+        self.network = network
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.max_batch_pixels = max_batch_pixels
+        self.rgb = rgb
+        self.preprocessing = preprocessing
+        self._queue = queue.Queue()
+        self._carry = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='BatchingPredictor', daemon=True)
+        self._thread.start()
+
+    def predict_image(self, image):
+        '''
+        Returns the probability map of the rescaled PIL image and the rescale factor,
+        like Network.predict_single_image_by_path
+        '''
+        from segmentation.dataset import decode_rescaled
+        image, rescale_factor = decode_rescaled(image)
+        data = self.network.prepare_image(np.array(image), rgb=self.rgb,
+                                          preprocessing=self.preprocessing)
+        future = Future()
+        # requests are never queued behind _STOP, where nobody would complete them
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('BatchingPredictor is closed')
+            self._queue.put((data, future))
+        return future.result(), rescale_factor
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        self._thread.join()
+
+    def _next(self, timeout=None):
+        if self._carry is not None:
+            item, self._carry = self._carry, None
+            return item
+        return self._queue.get(timeout=timeout)
+
+    def _collect(self):
+        first = self._next()
+        if first is _STOP:
+            return None
+        batch = [first]
+        # predict_batch pads every page to a multiple of 32 and runs pages of equal padded size together
+        pixels = _padded_pixels(first[0])
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._next(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                self._carry = item
+                break
+            item_pixels = _padded_pixels(item[0])
+            if pixels + item_pixels > self.max_batch_pixels:
+                self._carry = item
+                break
+            batch.append(item)
+            pixels += item_pixels
+        return batch
+
+    def _fail_pending(self):
+        pending = [self._carry] if self._carry is not None else []
+        self._carry = None
+        while True:
+            try:
+                pending.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        for item in pending:
+            if item is not _STOP:
+                item[1].set_exception(RuntimeError('BatchingPredictor is closed'))
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                self._fail_pending()
+                return
+            try:
+                outputs = self.network.predict_batch([data for data, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), output in zip(batch, outputs):
+                future.set_result(output)
+
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+    '''
+    POST /predict?output=baselines|probability with the encoded image as body
+    (or ?path=... for an image below the path_root of the server, if it has one).
+    baselines returns json with the baselines in original image coordinates,
+    probability returns the probability map of the rescaled image as .npy (rescale factor in X-Rescale-Factor).
+    GET /health returns {"status": "ok"}.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug('{} {}\n'.format(self.address_string(), format % args))
+
+    def _send(self, status, body: bytes, content_type: str, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, data):
+        self._send(status, json.dumps(data).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        from PIL import Image
+        from segmentation.pipeline import extract_page_baselines
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/predict':
+            self._send_json(404, {'error': 'not found'})
+            return
+        query = parse_qs(url.query)
+        output = query.get('output', ['baselines'])[0]
+        if output not in ('baselines', 'probability'):
+            self._send_json(400, {'error': 'unknown output {}'.format(output)})
+            return
+        if len(body) > 0:
+            source = io.BytesIO(body)
+        else:
+            source = self.server.resolve_path(query.get('path', [None])[0])
+            if source is None:
+                self._send_json(403, {'error': 'no image given or path not allowed'})
+                return
+        try:
+            image = Image.open(source)
+            image_size = image.size
+            probability_map, rescale_factor = self.server.predictor.predict_image(image)
+            if output == 'baselines':
+                baselines = extract_page_baselines(probability_map, rescale_factor)
+                self._send_json(200, {'baselines': baselines, 'width': image_size[0], 'height': image_size[1]})
+            else:
+                buffer = io.BytesIO()
+                np.save(buffer, probability_map)
+                self._send(200, buffer.getvalue(), 'application/x-npy',
+                           headers={'X-Rescale-Factor': repr(rescale_factor)})
+        except Exception as e:
+            logger.warning('Prediction failed: {}\n'.format(e))
+            self._send_json(500, {'error': str(e)})
+
+
+class _PathRootMixIn(object):
+    path_root = None
+
+    def resolve_path(self, path: str):
+        '''
+        Real path of an image requested by ?path=, None without path_root or if it resolves outside of path_root
+        '''
+        if path is None or self.path_root is None:
+            return None
+        root = os.path.realpath(self.path_root)
+        resolved = os.path.realpath(os.path.join(root, path))
+        if os.path.commonpath([root, resolved]) != root or not os.path.isfile(resolved):
+            return None
+        return resolved
+
+
+class PredictionServer(_PathRootMixIn, ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, predictor: BatchingPredictor, path_root: str = None):
+        super().__init__(address, PredictionRequestHandler)
+        self.predictor = predictor
+        self.path_root = path_root
+
+
+class UnixPredictionServer(_PathRootMixIn, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, predictor: BatchingPredictor, path_root: str = None):
+        super().__init__(path, PredictionRequestHandler)
+        self.predictor = predictor
+        self.path_root = path_root
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class RemoteNetwork(object):
+    '''
+    Client of a prediction server, usable in place of a Network for predict_single_image_by_path
+    (e.g. by the GUI). url is http://host:port or unix:///path/to/socket.
+    '''
+
+    def __init__(self, url: str, timeout: float = None):
+        self.url = urlparse(url)
+        self.timeout = timeout
+
+    def _connection(self):
+        if self.url.scheme == 'unix':
+            return _UnixHTTPConnection(self.url.path, timeout=self.timeout)
+        return http.client.HTTPConnection(self.url.hostname, self.url.port, timeout=self.timeout)
+
+    def _post(self, path: str, output: str):
+        with open(path, 'rb') as f:
+            body = f.read()
+        connection = self._connection()
+        try:
+            connection.request('POST', '/predict?' + urlencode({'output': output}), body=body)
+            response = connection.getresponse()
+            data = response.read()
+            if response.status != 200:
+                raise RuntimeError('Prediction of {} failed: {}'.format(path, json.loads(data).get('error')))
+            return response, data
+        finally:
+            connection.close()
+
+    def predict_single_image_by_path(self, path, rgb=True, preprocessing=True, tta_aug=None):
+        response, data = self._post(path, 'probability')
+        return np.load(io.BytesIO(data)), float(response.getheader('X-Rescale-Factor'))
+
+    def predict_baselines_by_path(self, path) -> List[List[List[int]]]:
+        '''
+        Baselines of the image in original image coordinates
+        '''
+        _, data = self._post(path, 'baselines')
+        return json.loads(data)['baselines']
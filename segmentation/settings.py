@@ -1,24 +1,28 @@
 from enum import Enum
 from segmentation.modules import Architecture
-from segmentation.dataset import MaskDataset
-from typing import NamedTuple
+from typing import NamedTuple, Tuple, TYPE_CHECKING
 from segmentation.optimizer import Optimizers
 from segmentation.model import CustomModel
+from segmentation.metrics import Metric
+
+if TYPE_CHECKING:
+    from segmentation.dataset import MaskDataset
 
 
 class TrainSettings(NamedTuple):
-    TRAIN_DATASET: MaskDataset
-    VAL_DATASET: MaskDataset
+    TRAIN_DATASET: 'MaskDataset'
+    VAL_DATASET: 'MaskDataset'
     CLASSES: int
     OUTPUT_PATH: str
 
-    PSEUDO_DATASET: MaskDataset = None
+    PSEUDO_DATASET: 'MaskDataset' = None
     EPOCHS: int = 15
     OPTIMIZER: Optimizers = Optimizers.ADAM
     LEARNINGRATE_ENCODER: float = 1.e-5
     LEARNINGRATE_DECODER: float = 1.e-4
     LEARNINGRATE_SEGHEAD: float = 1.e-4
     BATCH_ACCUMULATION: int = 8
+    # batches of more than one page are grouped by page size and padded to a multiple of 32
     TRAIN_BATCH_SIZE: int = 1
     VAL_BATCH_SIZE: int = 1
     ARCHITECTURE: Architecture = Architecture.UNET
@@ -27,12 +31,46 @@ class TrainSettings(NamedTuple):
     CUSTOM_MODEL: CustomModel = None
 
     PROCESSES: int = 4
+    # number of batches between two log lines / progress callbacks, reading the metrics syncs the device
+    LOG_INTERVAL: int = 10
+    # validation metric deciding which epoch is saved, loss is minimized, every other metric maximized
+    MODEL_SELECTION_METRIC: Metric = Metric.ACCURACY
+
+    # float16 autocast with gradient scaling on cuda, bfloat16 autocast on cpu
+    MIXED_PRECISION: bool = False
+    CHANNELS_LAST: bool = False
+    # augment and normalize collated training batches on the device (gpu_augmentation.base_line_augmentation)
+    # instead of the albumentations transform of TRAIN_DATASET in the DataLoader workers
+    GPU_AUGMENTATION: bool = False
+
+
+class OutputMode(Enum):
+    PROBABILITY = 'probability'  # float32 H x W x C model output
+    ARGMAX = 'argmax'  # uint8 H x W label map
+    QUANTIZED = 'quantized'  # uint8 H x W x C softmax probabilities scaled to 0..255
+    CHANNELS = 'channels'  # float32 H x W x len(OUTPUT_CHANNELS) subset of the model output
 
 
 class PredictorSettings(NamedTuple):
-    PREDICT_DATASET: MaskDataset = None
+    PREDICT_DATASET: 'MaskDataset' = None
+    # checkpoint (.torch) or exported model (.torchscript / .onnx, cpu only)
     MODEL_PATH: str = None
     PROCESSES: int = 4
+    # number of cpu threads used for inference, None keeps the torch default
+    THREADS: int = None
+
+    # Tiled inference, enabled if TILE_SIZE is set. Tiles of all pages are batched up to TILE_BATCH_PIXELS input pixels
+    TILE_SIZE: int = None
+    TILE_OVERLAP: int = 64
+    TILE_BATCH_PIXELS: int = 4 * 512 * 512
+
+    # float16 autocast on cuda, bfloat16 autocast on cpu
+    MIXED_PRECISION: bool = False
+    CHANNELS_LAST: bool = False
+
+    # output of the predict methods, reduced on the device before it is copied to the host
+    OUTPUT_MODE: OutputMode = OutputMode.PROBABILITY
+    OUTPUT_CHANNELS: Tuple[int, ...] = None
 
 
 class BaseLineDetectionSettings(NamedTuple):
@@ -0,0 +1,127 @@
+from collections import deque
+from typing import Callable, Iterable, List, Tuple, Any
+
+import torch
+
+
+def tile_offsets(length: int, tile_size: int, overlap: int) -> List[int]:
+    '''
+    returns the start offsets of the tiles along one axis. The last tile is
+    aligned to the end of the axis, so every tile has exactly tile_size pixels.
+    '''
+    stride = tile_size - overlap
+    if stride <= 0:
+        raise ValueError("Tile overlap ({}) must be smaller than the tile size ({})".format(overlap, tile_size))
+    if length <= tile_size:
+        return [0]
+    offsets = list(range(0, length - tile_size, stride))
+    offsets.append(length - tile_size)
+    return offsets
+
+
+def blend_window(tile_size: int, overlap: int, device=None, dtype=torch.float32):
+    '''
+    2D weight window of a tile. Weights ramp up linearly over the overlap
+    region, so overlapping logits are blended instead of cut at a seam.
+    All weights are > 0, which keeps the normalisation at page borders valid.
+    '''
+    ramp = torch.ones(tile_size, device=device, dtype=dtype)
+    if overlap > 0:
+        steps = torch.arange(1, overlap + 1, device=device, dtype=dtype) / (overlap + 1)
+        ramp[:overlap] = steps
+        ramp[-overlap:] = torch.min(ramp[-overlap:], steps.flip(0))
+    return ramp[:, None] * ramp[None, :]
+
+
+def pad_to_tile(tensor, tile_size: int):
+    shape = list(tensor.shape)[2:]
+    h_dif = max(tile_size - shape[0], 0)
+    x_dif = max(tile_size - shape[1], 0)
+    if h_dif != 0 or x_dif != 0:
+        tensor = torch.nn.functional.pad(input=tensor, pad=[0, x_dif, 0, h_dif])
+    return tensor
+
+
+class PageStitcher(object):
+    '''
+    Accumulates the weighted tile logits of a single page
+    '''
+
+    def __init__(self, key: Any, shape: Tuple[int, int], padded_shape: Tuple[int, int], n_tiles: int):
+        self.key = key
+        self.shape = shape
+        self.padded_shape = padded_shape
+        self.remaining = n_tiles
+        self.logits = None
+        self.weights = None
+
+    def add(self, y: int, x: int, logits, window):
+        if self.logits is None:
+            self.logits = logits.new_zeros((logits.shape[0],) + tuple(self.padded_shape))
+            self.weights = logits.new_zeros((1,) + tuple(self.padded_shape))
+        tile_h, tile_w = window.shape
+        self.logits[:, y:y + tile_h, x:x + tile_w] += logits * window
+        self.weights[:, y:y + tile_h, x:x + tile_w] += window
+        self.remaining -= 1
+
+    def done(self):
+        return self.remaining == 0
+
+    def result(self):
+        output = self.logits / self.weights
+        return output[None, :, :self.shape[0], :self.shape[1]]
+
+
+def predict_tiled(forward: Callable, pages: Iterable[Tuple[Any, torch.Tensor]], tile_size: int = 512,
+                  overlap: int = 64, batch_pixels: int = 4 * 512 * 512, passes: int = 1):
+    '''
+    Sliding window inference over a stream of pages.
+
+    Every page (a (1, C, H, W) tensor) is cut into overlapping tiles of a fixed size.
+    Tiles of consecutive pages are collected into batches of at most batch_pixels
+    input pixels and passed to forward. The logits are blended back per page.
+    :param forward: callable mapping a (N, C, tile_size, tile_size) batch to (N, classes, tile_size, tile_size) logits
+    :param pages: iterable of (key, tensor) tuples
+    :param passes: number of model inputs forward builds from every tile (e.g. the number of TTA transforms),
+        batches are shrunk accordingly so a forward pass stays within batch_pixels
+    :return: generator of (key, logits) tuples in input order, logits are of shape (1, classes, H, W)
+    '''
+    tiles_per_batch = max(1, batch_pixels // (tile_size * tile_size * max(1, passes)))
+    window = None
+    stitchers = deque()
+    tiles = []
+
+    def run_batch(batch):
+        nonlocal window
+        output = forward(torch.cat([tile for _, _, _, tile in batch]))
+        if window is None:
+            window = blend_window(tile_size, overlap, device=output.device, dtype=output.dtype)
+        for (stitcher, y, x, _), logits in zip(batch, output):
+            stitcher.add(y, x, logits, window)
+
+    def finished():
+        while len(stitchers) > 0 and stitchers[0].done():
+            stitcher = stitchers.popleft()
+            yield stitcher.key, stitcher.result()
+
+    for key, image in pages:
+        shape = list(image.shape)[2:]
+        padded = pad_to_tile(image, tile_size)
+        padded_shape = list(padded.shape)[2:]
+        ys = tile_offsets(padded_shape[0], tile_size, overlap)
+        xs = tile_offsets(padded_shape[1], tile_size, overlap)
+        stitcher = PageStitcher(key, shape, padded_shape, len(ys) * len(xs))
+        stitchers.append(stitcher)
+        for y in ys:
+            for x in xs:
+                tiles.append((stitcher, y, x, padded[:, :, y:y + tile_size, x:x + tile_size]))
+
+        while len(tiles) >= tiles_per_batch:
+            run_batch(tiles[:tiles_per_batch])
+            tiles = tiles[tiles_per_batch:]
+            yield from finished()
+
+    while len(tiles) > 0:
+        run_batch(tiles[:tiles_per_batch])
+        tiles = tiles[tiles_per_batch:]
+    yield from finished()
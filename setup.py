@@ -15,6 +15,8 @@ setup(
     author_email="alexander.hartelt@informatik.uni-wuerzburg.de",
     url="https://github.com/Gawajn/segmentation-pytorch",
     install_requires=open("requirements.txt").read().split(),
+    # model export (scripts/export.py) to ONNX and ONNX inference
+    extras_require={'onnx': ['onnx', 'onnxruntime']},
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)",